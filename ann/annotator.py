@@ -8,13 +8,42 @@
 __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
 import boto3
+from boto3.s3.transfer import S3Transfer, TransferConfig
 import json
+import logging
+import multiprocessing
 import os
 import sys
+import threading
 import time
-from subprocess import Popen, PIPE
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from logging.handlers import QueueHandler, QueueListener
+from botocore.config import Config
 from botocore.exceptions import ClientError, BotoCoreError
 
+from run import JOB_SKIPPED, run_job
+
+# Log through a queue so the pollers and job processes never block on stdout;
+# run.py logs to the 'ann.run' child logger, and each job process sends its records
+# back over this multiprocessing queue (see init_job_process)
+# Reference: Logging Cookbook - Dealing with handlers that block
+# https://docs.python.org/3/howto/logging-cookbook.html#dealing-with-handlers-that-block
+log = logging.getLogger('ann')
+log.setLevel(logging.INFO)
+log.propagate = False
+log_queue = multiprocessing.Queue()
+log.addHandler(QueueHandler(log_queue))
+log_handler = logging.StreamHandler(sys.stdout)
+log_handler.setFormatter(logging.Formatter('%(asctime)s %(processName)s %(threadName)s %(name)s %(levelname)s: %(message)s'))
+log_listener = QueueListener(log_queue, log_handler)
+
+# Prefer the C-accelerated orjson parser when it is installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 # Get configuration
 from configparser import ConfigParser, ExtendedInterpolation
 
@@ -24,20 +53,69 @@ config.read("annotator_config.ini")
 aws_region = config.get('aws', 'AwsRegionName')
 queue_url = config.get('sqs', 'QueueUrl')
 CNetID = config.get('DEFAULT', 'CnetId')
-annotations_table = config.get('gas', 'AnnotationsTable')
 max_number = int(config.get('sqs', 'MaxMessages'))
 wait_time = int(config.get('sqs', 'WaitTime'))
+busy_wait_time = int(config.get('sqs', 'BusyWaitTime'))
+poller_count = int(config.get('sqs', 'Pollers'))
+visibility_timeout = int(config.get('sqs', 'VisibilityTimeout'))
+max_jobs = int(config.get('ann', 'MaxJobs'))
+max_tasks_per_child = int(config.get('ann', 'MaxTasksPerChild'))
+
+# Create the AWS clients once so every poll reuses the same connection pools
+# (the job status is written by run_job, when the job starts and when it completes)
+# Reference: Session and client reuse
+# https://boto3.amazonaws.com/v1/documentation/api/latest/guide/session.html
+# The read timeout stays above the 20 second SQS long poll, and keep-alive holds idle pooled connections open
+# Reference: botocore Config
+# https://botocore.amazonaws.com/v1/documentation/api/latest/reference/config.html
+boto_config = Config(max_pool_connections=64, retries={'mode': 'adaptive', 'max_attempts': 10},
+                     tcp_keepalive=True, connect_timeout=10, read_timeout=70)
+session = boto3.session.Session()
+s3_client = session.client('s3', region_name=aws_region, config=boto_config)
+sqs_client = session.client('sqs', region_name=aws_region, config=boto_config)
+
+# Download large inputs in parallel ranged parts over the shared S3 client
+# Reference: TransferConfig
+# https://boto3.amazonaws.com/v1/documentation/api/latest/reference/customizations/s3.html#boto3.s3.transfer.TransferConfig
+MB = 1024 * 1024
+transfer_config = TransferConfig(multipart_threshold=8 * MB, multipart_chunksize=16 * MB, max_concurrency=16,
+                                 max_io_queue=1000, io_chunksize=1 * MB, use_threads=True)
+s3_transfer = S3Transfer(client=s3_client, config=transfer_config)
+
+# Worker threads shared by every poller; boto3 clients are safe to share across threads
+message_executor = ThreadPoolExecutor(max_workers=max_number * poller_count)
+
+# A poller only receives as many messages as there are free job slots, and a slot is released
+# when its job finishes, so no more than MaxJobs requests are ever taken off the queue at once
+# Reference: BoundedSemaphore
+# https://docs.python.org/3/library/threading.html#threading.BoundedSemaphore
+job_slots = threading.BoundedSemaphore(max_jobs)
+
+# Receipt handles of the messages whose jobs are downloading or running, keyed by job id; their visibility is
+# extended until the job finishes so the request is not delivered to another poller meanwhile
+running_messages = {}
+running_messages_lock = threading.Lock()
+
+# AnnTools is CPU-bound, so jobs run in worker processes instead of threads that share the GIL;
+# each worker keeps its driver imports and AWS clients for max_tasks_per_child jobs, then is replaced
+# Reference: ProcessPoolExecutor
+# https://docs.python.org/3/library/concurrent.futures.html#processpoolexecutor
+# The pool is created in main(), since spawned workers re-import this module
+job_executor = None
+
 """Reads request messages from SQS and runs AnnTools as a subprocess.
 
 Move existing annotator code here
 """
 
 
-def receive_sqs_messages(sqs):
+def receive_sqs_messages(sqs, wait_seconds=wait_time, max_messages=max_number):
     """
     Attempt to read a specified maximum number of messages from the queue using long polling.
 
     :param sqs: the queue to get message from
+    :param wait_seconds: how long to wait for messages to arrive before returning
+    :param max_messages: the most messages to receive (at most 10)
 
     :return: list A list of messages, each represented as a dictionary. Returns an empty list if no messages are
     available or an error occurs.
@@ -51,25 +129,26 @@ def receive_sqs_messages(sqs):
             QueueUrl=queue_url,
             AttributeNames=['All'],
             MessageAttributeNames=['All'],
-            MaxNumberOfMessages=max_number,
-            WaitTimeSeconds=wait_time
+            MaxNumberOfMessages=max_messages,
+            VisibilityTimeout=visibility_timeout,
+            WaitTimeSeconds=wait_seconds
         )
         return response.get('Messages', [])
     except ClientError as e:
         # Handle specific AWS client errors, such as access issues or resource not found
-        print(f"An AWS ClientError occurred: {e.response['Error']['Code']} - {e.response['Error']['Message']}")
+        log.error("An AWS ClientError occurred: %s - %s", e.response['Error']['Code'], e.response['Error']['Message'])
         return []
     except BotoCoreError as e:
         # Handle errors in the boto3 library itself
-        print(f"A BotoCoreError occurred: {str(e)}")
+        log.error("A BotoCoreError occurred: %s", e)
         return []
     except Exception as e:
         # Optional: Catch any other unexpected errors
-        print(f"An unexpected error occurred: {str(e)}")
+        log.error("An unexpected error occurred: %s", e)
         return []
 
 
-def copy_file_from_s3(s3_bucket_name, s3_file_name, local_user_id, local_uuid, local_prefix):
+def copy_file_from_s3(s3_bucket_name, s3_file_name, local_directory, local_file_path):
     """
     Copies a specified file from an AWS S3 bucket to a local directory, creating the directory if it does not exist.
 
@@ -77,212 +156,309 @@ def copy_file_from_s3(s3_bucket_name, s3_file_name, local_user_id, local_uuid, l
         The name of the S3 bucket from which to download the file.
     :param s3_file_name: str
         The name of the file to download from the S3 bucket.
-    :param local_user_id: str
-        The user identifier used to create a specific subdirectory path under the local basis directory.
-    :param local_uuid: str
-        The UUID associated with the specific job or session, used to create a unique subdirectory for storing the file.
-    :param local_prefix: str
-        The prefix within the S3 bucket under which to search for the file. This helps in filtering the objects list.
+    :param local_directory: str
+        The unique job directory (./anntools/data/<user_id>/<uuid>) that preserves the input file.
+    :param local_file_path: str
+        The path inside local_directory to download the file to.
     :return: bool
         Returns True if the file was successfully downloaded and False otherwise. This includes cases where the file
         does not exist or other errors occur during the download process.
     """
-    s3 = boto3.client('s3')
-    local_directory_base = f'./anntools/data/{local_user_id}'
     # Create unique local directory to preserve the input file
-    local_directory = os.path.join(local_directory_base, local_uuid)
     try:
         if not os.path.exists(local_directory):
             os.makedirs(local_directory)
     except OSError as e:
-        print(f"Failed to create directory {local_directory}: {e}")
+        log.error("Failed to create directory %s: %s", local_directory, e)
         return False
-    # List objects in the S3 bucket at the specified prefix
-    # Reference: list_objects_v2
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/list_objects_v2.html
+
+    # The message carries the exact input key, so download it directly and
+    # treat a missing object as a failed copy instead of listing the prefix first
+    log.debug("Downloading %s/%s to %s", s3_bucket_name, s3_file_name, local_file_path)
     try:
-        # List objects in the S3 bucket at the specified prefix
-        s3_response = s3.list_objects_v2(Bucket=s3_bucket_name, Prefix=local_prefix)
+        # Download the file
+        s3_transfer.download_file(s3_bucket_name, s3_file_name, local_file_path)
+        log.info("Downloaded %s to %s", s3_file_name, local_file_path)
+        return True
     except ClientError as e:
-        print(f"Error listing objects in bucket {s3_bucket_name} with prefix {local_prefix}: {e}")
-        return False
-
-
-    if 'Contents' in s3_response and len(s3_response['Contents']) > 0:
-        # There's only one file matches, and it starts with the uuid
-        local_file_path = os.path.join(local_directory, s3_file_name.split('~')[-1])
-        print(s3_bucket_name, s3_file_name, local_file_path)
-        try:
-            # Download the file
-            s3.download_file(s3_bucket_name, s3_file_name, local_file_path)
-            print(f"Downloaded {s3_file_name} to {local_file_path}")
-            return True
-        except ClientError as e:
-            # Check if the error was due to the file not being found
-            if e.response['Error']['Code'] == 'NoSuchKey':
-                print(f"File {s3_file_name} not found in bucket {s3_bucket_name}.")
-                return False
-            else:
-                # Other S3 related errors
-                print(f"Failed to download {s3_file_name}: {e}")
-                return False
-        except NotADirectoryError as e:
-            print(f"Target is not a directory: {e}")
+        # Check if the error was due to the file not being found
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            log.error("File %s not found in bucket %s.", s3_file_name, s3_bucket_name)
             return False
-        except Exception as e:
-            print(f"An unexpected error occurred: {e}")
+        else:
+            # Other S3 related errors
+            log.error("Failed to download %s: %s", s3_file_name, e)
             return False
-    else:
-        print("No files found at the specified prefix.")
+    except NotADirectoryError as e:
+        log.error("Target is not a directory: %s", e)
+        return False
+    except Exception as e:
+        log.error("An unexpected error occurred: %s", e)
         return False
 
 
-def spawn_annotation_process(local_user_name, local_uuid, local_file_name):
+def init_job_process(local_log_queue):
+    """
+    Send a job process's log records to the annotator's listener.
+
+    :param local_log_queue: the multiprocessing queue read by log_listener
+    """
+    job_log = logging.getLogger('ann')
+    job_log.handlers = [QueueHandler(local_log_queue)]
+
+
+def spawn_annotation_process(local_file_path, local_uuid, local_message_id, local_user_role=None):
     """
-    Launches an annotation process as a background subprocess using a specified Python script.
+    Launches an annotation job on the job executor, running run.py's pipeline in a worker process.
 
-    :param local_user_name: str
-        The identifier for the user under whose directory the file is located.
+    :param local_file_path: str
+        The path of the downloaded input file to be processed by the annotation job.
     :param local_uuid: str
         The unique identifier for the job.
-    :param local_file_name: str
-        The name of the file to be processed by the annotation job.
+    :param local_message_id: str
+        The id of the job's request message, which run_job records when it marks the job RUNNING.
+    :param local_user_role: str
+        The user's role when the job was submitted, if the request carried it.
     :return: bool
-        Returns True if the subprocess was successfully started, False if an error occurred which could be due
-        to file not being found, permission errors, or other unexpected issues.
+        Returns True if the job was successfully queued, False if an error occurred (e.g. the executor
+        has been shut down).
 
     """
     try:
-        # Construct the full path to the local file
-        run_file_path = os.path.join(f'./anntools/data/{local_user_name}', local_uuid, local_file_name.split('~')[-1])
-        # Start the annotation job as a background process
-        Popen(['python', './run.py', run_file_path, local_uuid])
-        print(
-            f"Annotation process started for ./anntools/data/{local_user_name} {run_file_path} {local_uuid}, running run.py.")
+        # Run the annotation job on a pooled worker process instead of starting a new interpreter for run.py
+        future = job_executor.submit(run_job, local_file_path, local_uuid, local_user_role, local_message_id)
+        # The callback runs on the pool's management thread, so hand the SQS call to a worker thread
+        future.add_done_callback(lambda f: message_executor.submit(finish_job, f, local_uuid))
+        log.info("Annotation job started for %s %s.", local_file_path, local_uuid)
         return True
-    except FileNotFoundError:
-        # Handle the case where the file to execute is not found (e.g., './anntools/run.py' does not exist)
-        print(
-            f"Error: The file './run.py' was not found. Unable to start annotation process for {local_uuid}.")
-        return False
-    except PermissionError:
-        # Handle the case where the Python script cannot be executed due to insufficient permissions
-        print(f"Error: Permission denied when trying to execute './run.py'. Check file permissions.")
-        return False
+    except RuntimeError as e:
+        # Raised when the executor no longer accepts work, e.g. during shutdown
+        log.error("Unable to start annotation job for %s: %s", local_uuid, e)
     except Exception as e:
-        # Catch all other exceptions that could be raised by subprocess.Popen
-        print(f"An unexpected error occurred while trying to start the annotation process for {local_uuid}: {str(e)}")
-        return False
+        # Catch all other exceptions that could be raised while queueing the job
+        log.error("An unexpected error occurred while trying to start the annotation process for %s: %s", local_uuid, e)
+    with running_messages_lock:
+        running_messages.pop(local_uuid, None)
+    return False
 
 
-def update_job_status(local_uuid):
+def finish_job(future, local_uuid):
     """
-    Update the job status from pending to running
+    Delete a job's request message once the job completes, or once run_job found nothing to do
+    for it (JOB_SKIPPED), and free its job slot.
+
+    A job that failed leaves its message on the queue, so it is delivered again once the
+    visibility timeout lapses (and moved to the dead-letter queue after repeated failures).
 
+    :param future: the future returned when the job was submitted
     :param local_uuid: str
         The unique identifier for the job.
-    :return: bool
-        True if the database was updated correctly, False otherwise
     """
+    with running_messages_lock:
+        receipt_handle = running_messages.pop(local_uuid, None)
     try:
-        dynamodb = boto3.resource('dynamodb', region_name=aws_region)
-        table = dynamodb.Table(annotations_table)
-        table.update_item(
-            Key={
-                'job_id': local_uuid
-            },
-            UpdateExpression="SET job_status = :new_status",
-            ConditionExpression="job_status = :current_status",
-            ExpressionAttributeValues={
-                ':new_status': 'RUNNING',
-                ':current_status': 'PENDING'
-            },
-            ReturnValues="UPDATED_NEW"
-        )
-        return True
-    except ClientError as e:
-        # Handle common DynamoDB client errors, such as ConditionalCheckFailedException
-        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
-            print(f"Condition check failed: Job {local_uuid} is not in PENDING state or doesn't exist.")
+        result = future.result()
+        if result:
+            if result == JOB_SKIPPED:
+                log.info("Annotation job %s had nothing left to do; deleting its request.", local_uuid)
+            delete_messages(sqs_client, [receipt_handle])
         else:
-            print(f"Failed to update job status for {local_uuid}: {e.response['Error']['Message']}")
-        return False  # Return False to indicate failure, and no response
+            log.warning("Annotation job %s did not complete successfully.", local_uuid)
+    except Exception as e:
+        log.error("Annotation job %s failed with an unexpected error: %s", local_uuid, e)
+    finally:
+        job_slots.release()
+
+
+def extend_visibility(sqs, local_receipt_handles):
+    """
+    Keep the messages of running jobs hidden for another visibility timeout.
 
+    :param sqs: the queue the messages were received from
+    :param local_receipt_handles: list of receipt handles of running jobs (at most 10)
+    :return: True if every message was extended, False otherwise
+    """
+    # Reference: Boto 3 documentation change_message_visibility_batch
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/change_message_visibility_batch.html
+    try:
+        response = sqs.change_message_visibility_batch(
+            QueueUrl=queue_url,
+            Entries=[{'Id': str(i), 'ReceiptHandle': receipt_handle, 'VisibilityTimeout': visibility_timeout}
+                     for i, receipt_handle in enumerate(local_receipt_handles)]
+        )
+        for failure in response.get('Failed', []):
+            log.error("Failed to extend message %s: %s", failure['Id'], failure.get('Message', failure['Code']))
+        return not response.get('Failed')
+    except ClientError as e:
+        log.error("Failed to extend the messages: %s", e.response['Error']['Message'])
+        return False
     except Exception as e:
-        # This catches any other exceptions that might occur
-        print(f"An unexpected error occurred while updating job status for {local_uuid}: {str(e)}")
+        log.error("An unexpected error occurred while extending the messages: %s", e)
         return False
 
 
-def delete_message(sqs, local_receipt_handle):
+def heartbeat_running_jobs(sqs):
+    # Extend the running jobs' messages every half visibility timeout, well before they reappear
+    while True:
+        time.sleep(visibility_timeout / 2)
+        with running_messages_lock:
+            receipt_handles = list(running_messages.values())
+        for i in range(0, len(receipt_handles), 10):
+            extend_visibility(sqs, receipt_handles[i:i + 10])
+
+
+def delete_messages(sqs, local_receipt_handles):
     """
-    Delete the message after the process spawned successfully
+    Delete a batch of messages after their jobs completed successfully
 
-    :param sqs: the queue to delete message from
-    :param local_receipt_handle: the receipt handle extracted from the message
-    :return: True if the message was deleted correctly, False otherwise
+    :param sqs: the queue to delete messages from
+    :param local_receipt_handles: list of receipt handles extracted from the messages (at most 10)
+    :return: True if every message was deleted correctly, False otherwise
     """
-    # Delete the message from the queue
-    # Reference: Boto 3 documentation receive_message
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/receive_message.html
+    # Delete the messages from the queue in a single request
+    # Reference: Boto 3 documentation delete_message_batch
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/delete_message_batch.html
     try:
-        sqs.delete_message(
+        response = sqs.delete_message_batch(
             QueueUrl=queue_url,
-            ReceiptHandle=local_receipt_handle
+            Entries=[{'Id': str(i), 'ReceiptHandle': receipt_handle}
+                     for i, receipt_handle in enumerate(local_receipt_handles)]
         )
-        return True
+        for failure in response.get('Failed', []):
+            log.error("Failed to delete message %s: %s", failure['Id'], failure.get('Message', failure['Code']))
+        return not response.get('Failed')
     except ClientError as e:
         # ClientError caught from boto3 call
-        print(f"Failed to delete the message: {e.response['Error']['Message']}")
+        log.error("Failed to delete the messages: %s", e.response['Error']['Message'])
         return False
     except Exception as e:
         # General exception catch, if unexpected error occurs
-        print(f"An unexpected error occurred while deleting the message: {str(e)}")
+        log.error("An unexpected error occurred while deleting the messages: %s", e)
         return False
 
 
-def handle_requests_queue(sqs=None):
-    # Read messages from the queue
-    messages = receive_sqs_messages(sqs)
-    if messages:
-        # Process messages
-        for message in messages:
-            # Double parse JSON as per SNS-SQS integration format
-            data = json.loads(json.loads(message['Body'])['Message'])
+def parse_job_request(body):
+    """
+    Parse the job request carried in an SQS message body.
+
+    :param body: str The message body
+    :return: dict The job request
+    """
+    data = json_loads(body)
+    # With raw message delivery enabled on the SNS subscription the body is the job request
+    # itself; otherwise it is the SNS envelope and the request is in its Message field
+    if data.get('Type') == 'Notification' and 'Message' in data:
+        return json_loads(data['Message'])
+    return data
+
+
+def process_message(message):
+    """
+    Copy the input file and spawn the annotation job for a single SQS message.
 
-            # Extract user_name, and uuid ect. from the received data
-            user_name = data.get('user_id')
-            uuid = data.get('job_id')
-            bucket_name = data.get('s3_inputs_bucket')
-            prefix_file = data.get('s3_key_input_file')
-            file_name = data.get('input_file_name')
-            prefix = f"{CNetID}/{user_name}/{uuid}"
-            receipt_handle = message['ReceiptHandle']
+    :param message: dict A message returned by receive_message
+    :return: bool
+        True if the job was started (its message is deleted when it completes), False otherwise
+    """
+    data = parse_job_request(message['Body'])
+
+    # Extract user_name, and uuid ect. from the received data
+    user_name = data.get('user_id')
+    uuid = data.get('job_id')
+    bucket_name = data.get('s3_inputs_bucket')
+    prefix_file = data.get('s3_key_input_file')
+
+    # Build the job's local paths once and share them between the download and the job
+    local_directory = f'./anntools/data/{user_name}/{uuid}'
+    local_file_path = f"{local_directory}/{prefix_file.split('~')[-1]}"
+
+    # A duplicate copy of a request for a job this instance is already running would download
+    # over the running job's input, so drop it here; the running job's own message is retried if it fails
+    with running_messages_lock:
+        duplicate = uuid in running_messages
+        if not duplicate:
+            running_messages[uuid] = message['ReceiptHandle']
+    if duplicate:
+        log.warning("Job %s is already running on this instance; deleting the duplicate request.", uuid)
+        delete_messages(sqs_client, [message['ReceiptHandle']])
+        return False
 
-            # Copy file from s3 bucket to instance
-            if not copy_file_from_s3(bucket_name, prefix_file, user_name, uuid, prefix):
-                continue
+    # Copy file from s3 bucket to instance
+    if not copy_file_from_s3(bucket_name, prefix_file, local_directory, local_file_path):
+        with running_messages_lock:
+            running_messages.pop(uuid, None)
+        return False
 
-            # Spawn an Annotate process
-            if not spawn_annotation_process(user_name, uuid, file_name):
-                continue
+    # Spawn an Annotate process
+    return spawn_annotation_process(local_file_path, uuid, message['MessageId'], data.get('user_role'))
 
-            # Update job status in the dynamodb
-            if not update_job_status(uuid):
-                continue
 
-            # Delete the message after spawning the subprocess
-            if not delete_message(sqs, receipt_handle):
-                continue
+def acquire_job_slots():
+    """
+    Wait for a free job slot, then take as many more free slots as one receive can use.
 
+    :return: int The number of slots taken
+    """
+    job_slots.acquire()
+    slots = 1
+    while slots < max_number and job_slots.acquire(blocking=False):
+        slots += 1
+    return slots
 
-def main():
-    # Get handles to queue
-    sqs = boto3.client('sqs', region_name=aws_region)
 
-    # Poll queue for new results and process them
+def handle_requests_queue(sqs=None, wait_seconds=wait_time):
+    """
+    Receive one batch of messages, no larger than the free job slots, and process it.
+
+    :param sqs: the queue to get messages from
+    :param wait_seconds: how long to wait for messages to arrive
+    :return: bool True if the batch filled every slot requested, False otherwise
+    """
+    slots = acquire_job_slots()
+    # Read messages from the queue
+    messages = receive_sqs_messages(sqs, wait_seconds, slots)
+    # Give back the slots this batch did not fill
+    for _ in range(slots - len(messages)):
+        job_slots.release()
+    if messages:
+        # Process messages concurrently so their S3 round-trips overlap, then wait for the
+        # whole batch before polling again; a started job keeps its slot until it finishes
+        futures = [message_executor.submit(process_message, message) for message in messages]
+        for future in as_completed(futures):
+            try:
+                started = future.result()
+            except Exception as e:
+                log.error("An unexpected error occurred while processing a message: %s", e)
+                started = False
+            if not started:
+                # The message is left on the queue and delivered again after its visibility timeout
+                job_slots.release()
+    return len(messages) == slots
+
+
+def poll_requests_queue(sqs):
+    # Poll queue for new results and process them; after a full batch the queue is
+    # likely still backed up, so use a short wait instead of the full long poll
+    batch_full = False
     while True:
-        handle_requests_queue(sqs)
+        wait_seconds = busy_wait_time if batch_full else wait_time
+        batch_full = handle_requests_queue(sqs, wait_seconds)
+
+
+def main():
+    global job_executor
+    log_listener.start()
+    job_executor = ProcessPoolExecutor(max_workers=max_jobs, max_tasks_per_child=max_tasks_per_child,
+                                       initializer=init_job_process, initargs=(log_queue,))
+    # Run several long-polling receivers against the same queue; the visibility
+    # timeout keeps them from receiving the same message twice
+    pollers = [threading.Thread(target=poll_requests_queue, args=(sqs_client,), daemon=True)
+               for _ in range(poller_count)]
+    for poller in pollers:
+        poller.start()
+    threading.Thread(target=heartbeat_running_jobs, args=(sqs_client,), daemon=True).start()
+    for poller in pollers:
+        poller.join()
 
 
 if __name__ == "__main__":
@@ -18,6 +18,7 @@ import sys
 import time
 from flask import Flask, jsonify, request
 from subprocess import Popen, PIPE
+from botocore.config import Config
 from botocore.exceptions import ClientError, BotoCoreError
 
 
@@ -28,15 +29,26 @@ app.url_map.strict_slashes = False
 environment = "annotator_webhook_config.Config"
 app.config.from_object(environment)
 
+# Share annotator.py's tuned client settings: the read timeout stays above the 20 second SQS
+# long poll, keep-alive holds idle pooled connections open, and adaptive retries absorb throttling
+# Reference: botocore Config
+# https://botocore.amazonaws.com/v1/documentation/api/latest/reference/config.html
+boto_config = Config(max_pool_connections=64, retries={'mode': 'adaptive', 'max_attempts': 10},
+                     tcp_keepalive=True, connect_timeout=10, read_timeout=70)
+
 # Connect to SQS and get the message queue
 aws_region = app.config["AWS_REGION_NAME"]
-sqs = boto3.client('sqs', region_name=aws_region)
+sqs = boto3.client('sqs', region_name=aws_region, config=boto_config)
 queue_url = app.config["AWS_QUEUE_URL"]
 CNetID = app.config["CNET_ID"]
 annotations_table = app.config["AWS_DYNAMODB_ANNOTATIONS_TABLE"]
 max_number = app.config["AWS_SQS_MAX_MESSAGES"]
 wait_time = app.config["AWS_SQS_WAIT_TIME"]
 
+# Build the DynamoDB resource and table once instead of on every status update
+dynamodb = boto3.resource('dynamodb', region_name=aws_region, config=boto_config)
+annotations = dynamodb.Table(annotations_table)
+
 
 def copy_file_from_s3(s3_bucket_name, s3_file_name, local_user_id, local_uuid, local_prefix):
     """
@@ -56,7 +68,7 @@ def copy_file_from_s3(s3_bucket_name, s3_file_name, local_user_id, local_uuid, l
         Returns True if the file was successfully downloaded and False otherwise. This includes cases where the file
         does not exist or other errors occur during the download process.
     """
-    s3 = boto3.client('s3')
+    s3 = boto3.client('s3', config=boto_config)
     local_directory_base = f'./anntools/data/{local_user_id}'
     # Create unique local directory to preserve the input file
     local_directory = os.path.join(local_directory_base, local_uuid)
@@ -154,10 +166,7 @@ def update_job_status(local_uuid):
         True if the database was updated correctly, False otherwise
     """
     try:
-        dynamodb = boto3.resource('dynamodb', region_name=aws_region)
-        table = dynamodb.Table(annotations_table)
-
-        table.update_item(
+        annotations.update_item(
             Key={
                 'job_id': local_uuid
             },
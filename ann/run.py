@@ -8,14 +8,19 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+import logging
 import os
 import sys
 import time
 import driver
 import boto3
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import S3Transfer, TransferConfig
+from botocore.config import Config
 from botocore.exceptions import BotoCoreError, ClientError
 import shutil
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 import json
 
 # Get configuration
@@ -34,6 +39,60 @@ wait_time = int(config.get('sqs', 'WaitTime'))
 result_topic_arn = config.get('sns', 'ResultTopicArn')
 state_machine_arn = config.get('state', 'StateMachineArn')
 
+# Logs go to the annotator's queued 'ann' handler when run_job is called from annotator.py
+log = logging.getLogger('ann.run')
+
+# Create the AWS clients once so uploads and updates share the same connection pools
+# Reference: Session and client reuse
+# https://boto3.amazonaws.com/v1/documentation/api/latest/guide/session.html
+# The read timeout stays above the 20 second SQS long poll, and keep-alive holds idle pooled connections open
+# Reference: botocore Config
+# https://botocore.amazonaws.com/v1/documentation/api/latest/reference/config.html
+boto_config = Config(max_pool_connections=64, retries={'mode': 'adaptive', 'max_attempts': 10},
+                     tcp_keepalive=True, connect_timeout=10, read_timeout=70)
+session = boto3.session.Session()
+s3_client = session.client('s3', region_name=aws_region, config=boto_config)
+sns_client = session.client('sns', region_name=aws_region, config=boto_config)
+sfn_client = session.client('stepfunctions', region_name=aws_region, config=boto_config)
+dynamodb = session.resource('dynamodb', region_name=aws_region, config=boto_config)
+annotations = dynamodb.Table(annotations_table)
+
+# Upload large results as parallel multipart parts over the shared S3 client
+# Reference: TransferConfig
+# https://boto3.amazonaws.com/v1/documentation/api/latest/reference/customizations/s3.html#boto3.s3.transfer.TransferConfig
+MB = 1024 * 1024
+transfer_config = TransferConfig(multipart_threshold=8 * MB, multipart_chunksize=16 * MB, max_concurrency=16,
+                                 max_io_queue=1000, io_chunksize=1 * MB, use_threads=True)
+s3_transfer = S3Transfer(client=s3_client, config=transfer_config)
+
+# The status updates have the same shape for every job, so build the expressions once;
+# a RUNNING job may only be started again by a redelivery of the request message that
+# started it (after a crash), never by a duplicate copy, and only a RUNNING job can be COMPLETED
+RUNNING_UPDATE_EXPRESSION = "SET job_status = :running, run_message_id = :message_id"
+RUNNING_CONDITION_EXPRESSION = "job_status = :pending OR (job_status = :running AND run_message_id = :message_id)"
+RUNNING_STATIC_VALUES = {
+    ':pending': 'PENDING',
+    ':running': 'RUNNING'
+}
+COMPLETED_UPDATE_EXPRESSION = ("SET s3_results_bucket = :res_bucket, s3_key_result_file = :res_key, "
+                               "s3_key_log_file = :log_key, complete_time = :comp_time, job_status = :status")
+COMPLETED_CONDITION_EXPRESSION = "job_status = :running"
+COMPLETED_STATIC_VALUES = {
+    ':res_bucket': bucket_name,
+    ':status': 'COMPLETED',
+    ':running': 'RUNNING'
+}
+
+# run_job's result for a request whose job is finished or started by another request;
+# there is nothing left to do for it, so its message can be deleted
+JOB_SKIPPED = "SKIPPED"
+
+# Threads for a job's independent uploads and finalization calls
+finalize_executor = ThreadPoolExecutor(max_workers=8)
+
+# A single thread deletes finished job directories off the critical path
+cleanup_executor = ThreadPoolExecutor(max_workers=1)
+
 """A rudimentary timer for coarse-grained profiling
 """
 
@@ -50,7 +109,7 @@ class Timer(object):
         self.end = time.time()
         self.secs = self.end - self.start
         if self.verbose:
-            print(f"Approximate runtime: {self.secs:.2f} seconds")
+            log.info("Approximate runtime: %.2f seconds", self.secs)
 
 
 def remove_directory(path):
@@ -63,16 +122,16 @@ def remove_directory(path):
         # Reference: shutil — High-level file operations
         # https://docs.python.org/3/library/shutil.html
         shutil.rmtree(path)
-        print(f"Directory {path} has been removed successfully.")
+        log.info("Directory %s has been removed successfully.", path)
         return True
     except FileNotFoundError:
-        print(f"Directory {path} does not exist.")
+        log.warning("Directory %s does not exist.", path)
         return False
     except PermissionError:
-        print(f"Permission denied: cannot remove directory {path}.")
+        log.error("Permission denied: cannot remove directory %s.", path)
         return False
     except Exception as e:
-        print(f"Failed to remove directory {path}: {str(e)}")
+        log.error("Failed to remove directory %s: %s", path, e)
         return False
 
 
@@ -83,150 +142,245 @@ def upload_file(local_file_path, s3_file_path):
     :param s3_file_path:
     :return: True if success, False otherwise
     """
-    # Create an S3 client
-    s3 = boto3.client('s3')
     try:
         # Upload the file
-        with open(local_file_path, 'rb') as data:
-            # Boto3 documentation: upload_fileobj
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/upload_fileobj.html
-            s3.upload_fileobj(data, bucket_name, s3_file_path)
-        print(f"File successfully uploaded to {bucket_name}/{s3_file_path}")
+        # Boto3 documentation: S3Transfer.upload_file
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/customizations/s3.html#boto3.s3.transfer.S3Transfer
+        s3_transfer.upload_file(local_file_path, bucket_name, s3_file_path)
+        log.info("File successfully uploaded to %s/%s", bucket_name, s3_file_path)
         return True
     # Track all error that might occur when upload file
-    except ClientError as error:
-        print(f"Failed to upload {local_file_path} to {s3_file_path}: {error}")
+    except (ClientError, S3UploadFailedError) as error:
+        log.error("Failed to upload %s to %s: %s", local_file_path, s3_file_path, error)
         return False
     except FileNotFoundError:
-        print(f"File {local_file_path} not found")
+        log.error("File %s not found", local_file_path)
         return False
     except Exception as error:
-        print(f"An error occurred: {error}")
+        log.error("An error occurred: %s", error)
         return False
 
 
 def start_state_machine(data):
-    client = boto3.client('stepfunctions', region_name=aws_region)
+    """
+    Start the archive state machine for a completed job.
+    :param data: the archive request passed to the state machine as input
+    :return: True if success, False otherwise
+    """
     # Reference: start_execution
     # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/stepfunctions/client/start_execution.html
     try:
-        response = client.start_execution(
+        response = sfn_client.start_execution(
             stateMachineArn=state_machine_arn,
             input=json.dumps(data)
         )
     except ClientError as e:
-        print("AWS client error occurred:", e)
+        log.error("AWS client error occurred: %s", e)
+        return False
     except Exception as e:
-        print("An unexpected error occurred:", e)        
-    print("State machine started:", response['executionArn'])
+        log.error("An unexpected error occurred: %s", e)
+        return False
+    log.info("State machine started: %s", response['executionArn'])
+    return True
 
 
+def update_job_running(uuid, message_id):
+    """
+    Mark a job RUNNING in DynamoDB before AnnTools starts on it.
+    :param uuid: the job id
+    :param message_id: the id of the request message that is starting the job
+    :return: True if success, JOB_SKIPPED if the job is finished or was started by another
+        request, False otherwise
+    """
+    # Reference: Update item
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/update_item.html
+    try:
+        annotations.update_item(
+            Key={
+                'job_id': uuid
+            },
+            UpdateExpression=RUNNING_UPDATE_EXPRESSION,
+            ConditionExpression=RUNNING_CONDITION_EXPRESSION,
+            ExpressionAttributeValues={
+                **RUNNING_STATIC_VALUES,
+                ':message_id': message_id
+            },
+            ReturnValues="NONE"
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            log.warning("Job %s is finished or was started by another request, so it was skipped.", uuid)
+            return JOB_SKIPPED
+        else:
+            log.error("DynamoDB Client Error: %s", e.response['Error']['Message'])
+        return False
+    except Exception as e:
+        log.error("An unexpected error occurred: %s", e)
+        return False
 
 
-if __name__ == '__main__':
-    # Call the AnnTools pipeline
-    if len(sys.argv) > 1:
+def update_job_completed(uuid, result_key, log_key, complete_time):
+    """
+    Record the result files and completion time of a job in DynamoDB.
+    :param uuid: the job id
+    :param result_key: S3 key of the annotated results file
+    :param log_key: S3 key of the log file
+    :param complete_time: ISO 8601 completion timestamp
+    :return: True if success, False otherwise
+    """
+    # run_job marked the job RUNNING before AnnTools started, so this conditional write
+    # moves it from RUNNING to COMPLETED
+    # Reference: Update item
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/update_item.html
+    try:
+        annotations.update_item(
+            Key={
+                'job_id': uuid
+            },
+            UpdateExpression=COMPLETED_UPDATE_EXPRESSION,
+            ConditionExpression=COMPLETED_CONDITION_EXPRESSION,
+            ExpressionAttributeValues={
+                **COMPLETED_STATIC_VALUES,
+                ':res_key': result_key,
+                ':log_key': log_key,
+                ':comp_time': complete_time
+            },
+            ReturnValues="UPDATED_NEW"
+        )
+        return True
+    except ClientError as e:
+        error_code = e.response['Error']['Code']
+        if error_code == 'ConditionalCheckFailedException':
+            log.error("Conditional check failed in run.py: %s", e.response['Error']['Message'])
+        else:
+            log.error("DynamoDB Client Error: %s", e.response['Error']['Message'])
+        return False
+    except Exception as e:
+        # Catch any other exceptions that may occur
+        log.error("An unexpected error occurred: %s", e)
+        return False
+
+
+def publish_result_notification(data):
+    """
+    Publish a job completion message to the results topic.
+    :param data: the notification payload
+    :return: True if success, False otherwise
+    """
+    try:
+        response = sns_client.publish(
+            TopicArn=result_topic_arn,
+            Message=json.dumps(data)
+        )
+        log.info("Message published successfully: %s", response)
+        return True
+    except ClientError as e:
+        # Handle client errors, such as issues with the network or incorrect AWS credentials
+        log.error("AWS client error occurred: %s", e)
+        return False
+    except BotoCoreError as e:
+        # Handle low-level exceptions, such as errors from the underlying HTTP library
+        log.error("BotoCore error occurred: %s", e)
+        return False
+    except Exception as e:
+        # Handle other possible exceptions
+        log.error("An error occurred: %s", e)
+        return False
+
+
+def run_job(input_file_path, uuid, user_role=None, message_id=None):
+    """
+    Run AnnTools on a local input file, then upload the results, record completion and notify the user.
+
+    :param input_file_path: str
+        The path of the input file, in the form ./anntools/data/<user_id>/<uuid>/<file_name>
+    :param uuid: str
+        The unique identifier for the job.
+    :param user_role: str
+        The user's role when the job was submitted; passed on to the archive step as user_tier.
+    :param message_id: str
+        The id of the request message; without one the caller has already marked the job
+        RUNNING (as annotator_webhook.py does before it starts run.py).
+    :return: bool
+        True if the job was finalized and the user notified, JOB_SKIPPED if there was nothing
+        to do for the request, False otherwise
+    """
+    # split the input path once and derive every local path and S3 key from it
+    job_directory, original_file_name = os.path.split(input_file_path)
+    # Mark the job RUNNING before any work is done on it
+    if message_id is not None:
+        running = update_job_running(uuid, message_id)
+        if running is not True:
+            cleanup_executor.submit(remove_directory, job_directory)
+            return running
+    # Call the AnnTools pipeline; a failed run leaves the job RUNNING for the request's
+    # redelivery to start again, so only its directory needs cleaning up here
+    try:
         with Timer():
-            driver.run(sys.argv[1], 'vcf')
-        user_name = sys.argv[1].split('/')[3]
-        uuid = sys.argv[2]
-        original_file_name = sys.argv[1].split('/')[5]
-        # generate file_name to upload
-        annot_file_name = original_file_name.split('.')[0] + '.annot.vcf'
-        log_file_name = original_file_name + '.count.log'
-        # find the path of file to be uploaded
-        annot_file_path = os.path.join(f'./anntools/data/{user_name}', uuid, annot_file_name)
-        log_file_path = sys.argv[1] + '.count.log'
-        prefix = f"{CNetID}/{user_name}/{uuid}/"
-        # try to upload file, and catch exception in the upload_file function
-        if not upload_file(annot_file_path, prefix + annot_file_name):
-            print(f"Error uploading annotation file to S3.")
-        if not upload_file(log_file_path, prefix + log_file_name):
-            print(f"Error uploading log file to S3.")
-        if not remove_directory(os.path.join(f'./anntools/data/{user_name}', uuid)):
-            print(f"Error removing the directory")
-
-        dynamodb = boto3.resource('dynamodb', region_name=aws_region)
-        table = dynamodb.Table(annotations_table)
-
-        current_time = datetime.utcnow().isoformat() + 'Z'
-
-        # Reference: Update item
-        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/update_item.html
-        try:
-            response = table.update_item(
-                Key={
-                    'job_id': uuid
-                },
-                UpdateExpression="""
-                            SET s3_results_bucket = :res_bucket,
-                                s3_key_result_file = :res_key,
-                                s3_key_log_file = :log_key,
-                                complete_time = :comp_time,
-                                job_status = :status
-                        """,
-                ExpressionAttributeValues={
-                    ':res_bucket': bucket_name,
-                    ':res_key': prefix + annot_file_name,
-                    ':log_key': prefix + log_file_name,
-                    ':comp_time': current_time,
-                    ':status': 'COMPLETED'
-                },
-                ReturnValues="UPDATED_NEW"
-            )
-        except ClientError as e:
-            error_code = e.response['Error']['Code']
-            if error_code == 'ConditionalCheckFailedException':
-                print("Conditional check failed in run.py:", e.response['Error']['Message'])
-            else:
-                print("DynamoDB Client Error:", e.response['Error']['Message'])
-            sys.exit()
-        except Exception as e:
-            # Catch any other exceptions that may occur
-            print("An unexpected error occurred:", str(e))
-            sys.exit()
-        
-        # sqs notification
-        result_notification_data = {
-            "user_id": user_name,
-            "job_id": uuid,
-            "complete_time": current_time
-        }
-
-        # Initialize SNS client
-        sns = boto3.client('sns', region_name=aws_region)
-        try:
-            response = sns.publish(
-                TopicArn=result_topic_arn,
-                Message=json.dumps(result_notification_data)
-            )
-            print("Message published successfully:", response)
-        except ClientError as e:
-            # Handle client errors, such as issues with the network or incorrect AWS credentials
-            print("AWS client error occurred:", e)
-            sys.exit()
-        except BotoCoreError as e:
-            # Handle low-level exceptions, such as errors from the underlying HTTP library
-            print("BotoCore error occurred:", e)
-            sys.exit()
-        except Exception as e:
-            # Handle other possible exceptions
-            print("An error occurred:", e)
-            sys.exit()
-
-            
-            
-        archive_notification_data = {
-            "user_id": user_name,
-            "job_id": uuid,
-            "s3_key_result_file": prefix + annot_file_name,
-            
-        }   
-        
-        start_state_machine(archive_notification_data)
-
-            
+            driver.run(input_file_path, 'vcf')
+    except Exception as e:
+        log.error("AnnTools failed on job %s: %s", uuid, e)
+        cleanup_executor.submit(remove_directory, job_directory)
+        return False
+    user_name = input_file_path.split('/')[3]
+    # generate file_name to upload
+    annot_file_name = original_file_name.split('.')[0] + '.annot.vcf'
+    log_file_name = original_file_name + '.count.log'
+    # find the path of file to be uploaded
+    annot_file_path = os.path.join(job_directory, annot_file_name)
+    log_file_path = os.path.join(job_directory, log_file_name)
+    prefix = f"{CNetID}/{user_name}/{uuid}/"
+    result_key = prefix + annot_file_name
+    log_key = prefix + log_file_name
+    # upload the annotation and log files concurrently; upload_file catches its own exceptions
+    annot_upload = finalize_executor.submit(upload_file, annot_file_path, result_key)
+    log_upload = finalize_executor.submit(upload_file, log_file_path, log_key)
+    annot_uploaded = annot_upload.result()
+    log_uploaded = log_upload.result()
+    # remove the job directory in the background; remove_directory logs its own failures
+    cleanup_executor.submit(remove_directory, job_directory)
+    # never mark a job COMPLETED or archive it unless both files are in S3
+    if not annot_uploaded:
+        log.error("Error uploading annotation file to S3.")
+        return False
+    if not log_uploaded:
+        log.error("Error uploading log file to S3.")
+        return False
+
+    # timezone-aware clock with a fixed millisecond precision, so the .%fZ format parsers always match
+    current_time = datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+    # The notification and the archive state machine both rely on the job being COMPLETED,
+    # so they are issued together only after the database update succeeds
+    result_notification_data = {
+        "user_id": user_name,
+        "job_id": uuid,
+        "complete_time": current_time
+    }
+    archive_notification_data = {
+        "user_id": user_name,
+        "job_id": uuid,
+        "s3_key_result_file": result_key,
+    }
+    if user_role:
+        # The state machine sets this as the user_tier message attribute so the
+        # archive subscription's filter policy can drop premium users' jobs
+        archive_notification_data["user_tier"] = user_role
+    if not update_job_completed(uuid, result_key, log_key, current_time):
+        return False
+    finalize_steps = [
+        finalize_executor.submit(publish_result_notification, result_notification_data),
+        finalize_executor.submit(start_state_machine, archive_notification_data),
+    ]
+    return all([step.result() for step in finalize_steps])
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) > 2:
+        run_job(sys.argv[1], sys.argv[2])
     else:
-        print("A valid .vcf file must be provided as input to this program.")
+        log.error("A valid .vcf file must be provided as input to this program.")
 
-### EOF
\ No newline at end of file
+### EOF
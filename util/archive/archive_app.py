@@ -8,14 +8,29 @@
 __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
 import boto3
+import hashlib
 import json
-import requests
+import logging
+import urllib3
 import sys
 import time
 import os
 import shutil
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
 from botocore.exceptions import ClientError, BotoCoreError
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request
+
+# Prefer the C-accelerated orjson parser and encoder when it is installed
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+    json_dumps = json.dumps
 
 # Import utility helpers
 sys.path.insert(1, os.path.realpath(os.path.pardir))
@@ -35,33 +50,175 @@ environment = "archive_app_config.Config"
 app.config.from_object(environment)
 
 
+# Log with lazily formatted arguments instead of eagerly built print strings
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(threadName)s %(levelname)s: %(message)s')
+log = logging.getLogger(__name__)
+
 aws_region = app.config['AWS_REGION_NAME']
 s3_result_bucket_name = app.config['AWS_S3_BUCKET_NAME']
 vault_name = app.config['AWS_VAULT_NAME']
 annotations_table = app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE']
-
-
-
-def upload_to_glacier_vault(file_path):
-    # Upload file to glacier vault
-    glacier = boto3.client('glacier', region_name=aws_region)
+multipart_threshold = app.config['AWS_GLACIER_MULTIPART_THRESHOLD']
+part_size = app.config['AWS_GLACIER_PART_SIZE']
+upload_workers = app.config['AWS_GLACIER_UPLOAD_WORKERS']
+s3_endpoint_url = app.config['AWS_S3_ENDPOINT_URL']
+dynamodb_endpoint_url = app.config['AWS_DYNAMODB_ENDPOINT_URL']
+archive_claim_timeout = app.config['ARCHIVE_CLAIM_TIMEOUT']
+
+# Create the AWS clients once so every archive request reuses the same kept-alive connections
+# Reference: Session and client reuse
+# https://boto3.amazonaws.com/v1/documentation/api/latest/guide/session.html
+# (the read timeout leaves room for Glacier to acknowledge a large single-shot upload)
+boto_config = Config(max_pool_connections=50, tcp_keepalive=True, connect_timeout=2, read_timeout=60,
+                     retries={'mode': 'adaptive', 'max_attempts': 3})
+s3_client = boto3.client('s3', region_name=aws_region, endpoint_url=s3_endpoint_url, config=boto_config)
+glacier_client = boto3.client('glacier', region_name=aws_region, config=boto_config)
+# The low-level DynamoDB client skips the resource layer's type (de)serialization
+dynamodb_client = boto3.client('dynamodb', region_name=aws_region, endpoint_url=dynamodb_endpoint_url,
+                               config=boto_config)
+
+# Keep the SubscribeURL confirmation connections alive between requests; urllib3 already
+# ships with botocore, so this avoids importing requests
+# Reference: urllib3 PoolManager
+# https://urllib3.readthedocs.io/en/stable/reference/urllib3.poolmanager.html
+http_pool = urllib3.PoolManager(num_pools=4, maxsize=4, retries=urllib3.Retry(3), timeout=urllib3.Timeout(total=5))
+
+# claim_archive results other than a claim time
+ARCHIVED = "ARCHIVED"
+BUSY = "BUSY"
+
+# Result files up to this size are spooled in memory on their way to Glacier
+spool_max_size = 8 * 1024 * 1024
+spool_chunk_size = 64 * 1024
+
+# Threads that send the parts of multipart Glacier uploads
+glacier_executor = ThreadPoolExecutor(max_workers=upload_workers)
+
+MB = 1024 * 1024
+
+
+def tree_hash(hashes):
+    """
+    Combine SHA-256 digests pairwise, level by level, until one root digest remains.
+    Reference: Computing checksums
+    https://docs.aws.amazon.com/amazonglacier/latest/dev/checksum-calculations.html
+    :param hashes: list of digests, in order
+    :return: bytes the root digest
+    """
+    while len(hashes) > 1:
+        hashes = [hashlib.sha256(hashes[i] + hashes[i + 1]).digest() if i + 1 < len(hashes) else hashes[i]
+                  for i in range(0, len(hashes), 2)]
+    return hashes[0]
+
+
+def part_tree_hash(data):
+    """
+    Compute the Glacier tree hash of one part from its 1 MiB chunks.
+    :param data: bytes of the part
+    :return: bytes the part's tree hash digest
+    """
+    return tree_hash([hashlib.sha256(data[i:i + MB]).digest() for i in range(0, len(data), MB)]
+                     or [hashlib.sha256(b'').digest()])
+
+
+def upload_part(upload_id, offset, data):
+    """
+    Upload one part of a multipart Glacier upload.
+    :param upload_id: the multipart upload id
+    :param offset: byte offset of the part in the archive
+    :param data: bytes of the part
+    :return: bytes the part's tree hash digest
+    """
+    checksum = part_tree_hash(data)
+    # Reference: upload_multipart_part
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/upload_multipart_part.html
+    glacier_client.upload_multipart_part(
+        vaultName=vault_name,
+        uploadId=upload_id,
+        range=f"bytes {offset}-{offset + len(data) - 1}/*",
+        body=data,
+        checksum=checksum.hex()
+    )
+    return checksum
+
+
+def glacier_multipart_upload(body, archive_size):
+    """
+    Upload a file-like body to Glacier as a multipart upload, sending parts in parallel.
+    Because every part but the last is a power-of-two number of MiB, the archive's tree
+    hash is the tree hash of the part hashes.
+    :param body: readable file-like object positioned at the start of the archive
+    :param archive_size: total size of the archive in bytes
+    :return: str the archive id
+    """
+    # Reference: initiate_multipart_upload
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/initiate_multipart_upload.html
+    upload_id = glacier_client.initiate_multipart_upload(vaultName=vault_name, partSize=str(part_size))['uploadId']
     try:
-        with open(file_path, 'rb') as file:
-            # Reference: glacier upload_archive
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/upload_archive.html
-            response = glacier.upload_archive(vaultName=vault_name, body=file)
-        print(f"File uploaded to Glacier vault {vault_name}. Archive ID: {response['archiveId']}")
-    except FileNotFoundError:
-        print(f"Error: The file at {file_path} was not found.")
-        return None
-    except IOError as e:
-        print(f"Error: Unable to read the file at {file_path}. IOError: {e}")
-        return None
-    except ClientError as e:
-        print(f"Error: AWS client encountered an issue: {e}")
-        return None
-    return response['archiveId']
-
+        # Keep at most one part per worker in flight so memory stays bounded by the pool size
+        in_flight = deque()
+        part_hashes = []
+        offset = 0
+        while offset < archive_size:
+            data = body.read(part_size)
+            if not data:
+                break
+            if len(in_flight) >= upload_workers:
+                part_hashes.append(in_flight.popleft().result())
+            in_flight.append(glacier_executor.submit(upload_part, upload_id, offset, data))
+            offset += len(data)
+        while in_flight:
+            part_hashes.append(in_flight.popleft().result())
+
+        # Reference: complete_multipart_upload
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/complete_multipart_upload.html
+        response = glacier_client.complete_multipart_upload(
+            vaultName=vault_name,
+            uploadId=upload_id,
+            archiveSize=str(offset),
+            checksum=tree_hash(part_hashes).hex()
+        )
+        return response['archiveId']
+    except Exception:
+        # Reference: abort_multipart_upload
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/abort_multipart_upload.html
+        glacier_client.abort_multipart_upload(vaultName=vault_name, uploadId=upload_id)
+        raise
+
+
+def archive_tree_hash(body):
+    """
+    Compute the Glacier tree hash of a seekable body, hashing part-sized blocks on the
+    upload threads (hashlib releases the GIL while it hashes) and combining the block hashes.
+    :param body: seekable file-like object positioned at the start of the archive
+    :return: str the hex tree hash; the body is rewound to the start
+    """
+    in_flight = deque()
+    block_hashes = []
+    for data in iter(lambda: body.read(part_size), b''):
+        if len(in_flight) >= upload_workers:
+            block_hashes.append(in_flight.popleft().result())
+        in_flight.append(glacier_executor.submit(part_tree_hash, data))
+    while in_flight:
+        block_hashes.append(in_flight.popleft().result())
+    body.seek(0)
+    return tree_hash(block_hashes or [hashlib.sha256(b'').digest()]).hex()
+
+
+def upload_archive(body, archive_size):
+    """
+    Upload a seekable body to Glacier, using a multipart upload for large archives.
+    :param body: seekable file-like object positioned at the start of the archive
+    :param archive_size: total size of the archive in bytes
+    :return: str the archive id
+    """
+    if archive_size >= multipart_threshold:
+        return glacier_multipart_upload(body, archive_size)
+    # Supplying the tree hash keeps botocore from computing it in a single thread
+    # Reference: upload_archive
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/upload_archive.html
+    return glacier_client.upload_archive(vaultName=vault_name, body=body,
+                                         checksum=archive_tree_hash(body))['archiveId']
 
 
 def delete_from_s3(bucket_name, file_key):
@@ -69,76 +226,216 @@ def delete_from_s3(bucket_name, file_key):
     # Reference: delete objects
     # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/delete_object.html
     try:
-        s3 = boto3.client('s3')
-        s3.delete_object(Bucket=bucket_name, Key=file_key)
-        print(f"Deleted {file_key} from S3 bucket {bucket_name}")
+        s3_client.delete_object(Bucket=bucket_name, Key=file_key)
+        log.info("Deleted %s from S3 bucket %s", file_key, bucket_name)
         return True
     except ClientError as e:
         # This will catch client-side issues such as incorrect access permissions, non-existent bucket, etc.
-        print(f"Client error when trying to delete from S3: {e}")
+        log.error("Client error when trying to delete from S3: %s", e)
         return False
     except Exception as e:
         # This is a catch-all for any other exceptions that might be raised.
-        print(f"Unexpected error: {e}")
+        log.error("Unexpected error: %s", e)
         return False
 
 
 
-def update_dynamodb(job_id, archive_id):
-    # Update the database to include the archive_id
-    dynamodb = boto3.resource('dynamodb', region_name=aws_region)
-    table = dynamodb.Table(annotations_table)
+def claim_archive(job_id):
+    # Record that this request is archiving the job, so an SNS redelivery that arrives while the
+    # upload is still running does not upload a second archive. A claim older than
+    # archive_claim_timeout was left by a request that died mid-upload and may be taken over.
+    # Returns the claim time, ARCHIVED if the job already has an archive, BUSY if another
+    # request holds a fresh claim, or None on error
+    # Reference: Update item
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/update_item.html
+    now = str(int(time.time()))
+    try:
+        dynamodb_client.update_item(
+            TableName=annotations_table,
+            Key={
+                'job_id': {'S': job_id}
+            },
+            UpdateExpression="SET archive_claimed_at = :now",
+            ConditionExpression="attribute_not_exists(results_file_archive_id) AND "
+                                "(attribute_not_exists(archive_claimed_at) OR archive_claimed_at < :stale)",
+            ExpressionAttributeValues={
+                ':now': {'N': now},
+                ':stale': {'N': str(int(now) - archive_claim_timeout)}
+            },
+            ReturnValues="NONE",
+            ReturnValuesOnConditionCheckFailure="ALL_OLD"
+        )
+        return now
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            if 'results_file_archive_id' in e.response.get('Item', {}):
+                log.info("Job %s is already archived", job_id)
+                return ARCHIVED
+            log.warning("Job %s is already being archived", job_id)
+            return BUSY
+        log.error("DynamoDB Client Error: %s", e.response['Error']['Message'])
+        return None
+    except Exception as e:
+        log.error("An unexpected error occurred: %s", e)
+        return None
+
+
+def release_archive(job_id, claimed_at):
+    # Drop this request's claim after a failed attempt, so the retried request can archive right away
+    try:
+        dynamodb_client.update_item(
+            TableName=annotations_table,
+            Key={
+                'job_id': {'S': job_id}
+            },
+            UpdateExpression="REMOVE archive_claimed_at",
+            ConditionExpression="archive_claimed_at = :claimed_at",
+            ExpressionAttributeValues={':claimed_at': {'N': claimed_at}}
+        )
+        return True
+    except ClientError as e:
+        log.error("DynamoDB Client Error: %s", e.response['Error']['Message'])
+        return False
+    except Exception as e:
+        log.error("An unexpected error occurred: %s", e)
+        return False
+
+
+def update_dynamodb(job_id, archive_id, archive_size, claimed_at):
+    # Update the database to include the archive_id and its size, which the thaw
+    # utility uses to pick a retrieval tier; the condition makes sure this request
+    # still holds the claim, so only one archive is ever recorded for a job
     # Reference: Update item
     # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/update_item.html
     try:
         # Update item in DynamoDB table
-        response = table.update_item(
+        dynamodb_client.update_item(
+            TableName=annotations_table,
             Key={
-                'job_id': job_id  
+                'job_id': {'S': job_id}
             },
-            UpdateExpression="SET results_file_archive_id = :archive_id",
+            UpdateExpression="SET results_file_archive_id = :archive_id, results_file_archive_size = :archive_size "
+                             "REMOVE archive_claimed_at",
+            ConditionExpression="archive_claimed_at = :claimed_at",
             ExpressionAttributeValues={
-                ':archive_id': archive_id  
+                ':archive_id': {'S': archive_id},
+                ':archive_size': {'N': str(archive_size)},
+                ':claimed_at': {'N': claimed_at}
             },
-            ReturnValues="UPDATED_NEW"
+            ReturnValues="NONE"
         )
         return True
     except ClientError as e:
         # Handle specific client errors as needed
-        print("DynamoDB Client Error:", e.response['Error']['Message'])
+        log.error("DynamoDB Client Error: %s", e.response['Error']['Message'])
         return False
     except Exception as e:
         # General exception handling
-        print("An unexpected error occurred:", str(e))
+        log.error("An unexpected error occurred: %s", e)
         return False
 
 
-def move_to_glacier(bucket_name, file_key):
-    s3 = boto3.client('s3')
-    glacier = boto3.client('glacier', region_name=aws_region)
-    # Reference: get_object
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/get_object.html
+def delete_glacier_archive(archive_id):
+    # Delete an archive that was uploaded but never recorded, so it is not left orphaned
+    # Reference: delete_archive
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/delete_archive.html
     try:
-        response = s3.get_object(Bucket=bucket_name, Key=file_key)
-        data = response['Body'].read()
+        glacier_client.delete_archive(vaultName=vault_name, archiveId=archive_id)
+        return True
     except ClientError as e:
-        print(f"An error occurred: {e.response['Error']['Message']}")
-        return None
-    # Reference: upload_archive
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/upload_archive.html
+        log.error("An error occurred while deleting archive %s: %s", archive_id, e.response['Error']['Message'])
+        return False
+    except Exception as e:
+        log.error("Unexpected error occurred while deleting archive %s: %s", archive_id, e)
+        return False
+
+
+def archive_results(job_id, user_id, s3_key_result_file):
+    """
+    Move a free user's result file from S3 to Glacier and record the archive id.
+    Runs before the request that triggered it returns, so a failure can be retried by SNS.
+    :param job_id: the job id
+    :param user_id: the user who owns the job
+    :param s3_key_result_file: S3 key of the results file
+    :return: True if the file was archived or does not need archiving, BUSY if another request
+        is archiving it, False otherwise
+    """
     try:
-        glacier_response = glacier.upload_archive(
-            vaultName=vault_name,
-            body=data,
-            )
-        archive_id = glacier_response['archiveId']
-        return archive_id
-    except ClientError as e:
-        print(f"An errored when archiving to Glacier: {e}")
-        return None
+        # Free (or unknown) tier: confirm with the current profile in case the user upgraded since;
+        # a cached profile could still say free_user after the upgrade's thaw sweep has run
+        profile = helpers.get_user_profile(user_id, accounts_database)
+        log.info('profile: %s', profile)
+
+        if profile[4] != 'free_user':
+            log.info("Premium user, do not need archive")
+            return True
+
+        log.info("Free_user, archiving....")
+        # Claim the job first; a job that already has an archive only needs its S3 copy removed
+        claimed_at = claim_archive(job_id)
+        if claimed_at is None or claimed_at == BUSY:
+            return claimed_at or False
+        if claimed_at != ARCHIVED:
+            # MOVE FROM S3 To GLACIER
+
+            # Upload the file to glacier
+            archive_id, archive_size = move_to_glacier(s3_result_bucket_name, s3_key_result_file)
+            if archive_id is None:
+                log.error("In archive_app.py failed to upload the file of job %s to glacier", job_id)
+                release_archive(job_id, claimed_at)
+                return False
+
+            # Update database before removing the S3 copy, so a failure at any step leaves the
+            # result file in S3 for the retried request to archive again
+            if not update_dynamodb(job_id, archive_id, archive_size, claimed_at):
+                log.error("In archive_app.py failed to update database for job %s", job_id)
+                delete_glacier_archive(archive_id)
+                release_archive(job_id, claimed_at)
+                return False
+
+        # remove file from s3; deleting a key that is already gone succeeds
+        if not delete_from_s3(s3_result_bucket_name, s3_key_result_file):
+            log.error("In archive_app.py failed to delete the file of job %s from s3", job_id)
+            return False
 
+        log.info("Archive request for job %s processed successfully", job_id)
+        return True
+    except Exception as e:
+        log.error("An unexpected error occurred while archiving job %s: %s", job_id, e)
+        return False
 
 
+def move_to_glacier(bucket_name, file_key):
+    # Glacier computes a tree hash over the body before sending it, so the body must be
+    # seekable; spool the S3 stream in chunks, keeping small files in memory and
+    # letting large ones roll over to disk instead of reading the whole object at once.
+    # Returns the archive id and the archive size in bytes, or (None, None) on failure
+    # Reference: tempfile.SpooledTemporaryFile
+    # https://docs.python.org/3/library/tempfile.html#tempfile.SpooledTemporaryFile
+    with tempfile.SpooledTemporaryFile(max_size=spool_max_size) as spool:
+        # Reference: get_object
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/get_object.html
+        try:
+            response = s3_client.get_object(Bucket=bucket_name, Key=file_key)
+            shutil.copyfileobj(response['Body'], spool, spool_chunk_size)
+            archive_size = spool.tell()
+            spool.seek(0)
+        except ClientError as e:
+            log.error("An error occurred: %s", e.response['Error']['Message'])
+            return None, None
+        try:
+            return upload_archive(spool, archive_size), archive_size
+        except ClientError as e:
+            log.error("An errored when archiving to Glacier: %s", e)
+            return None, None
+
+
+
+
+def json_response(payload, status=200):
+    # Serialize the response body directly instead of going through jsonify
+    return Response(json_dumps(payload), status=status, mimetype='application/json')
+
 
 @app.route("/", methods=["GET"])
 def home():
@@ -147,49 +444,48 @@ def home():
 
 @app.route("/archive", methods=["POST"])
 def archive_free_user_data():
-    data = json.loads(request.data)
+    data = json_loads(request.data)
     if data['Type'] == 'SubscriptionConfirmation':
         # Confirm the subscription by visiting the SubscribeURL
-        response = requests.get(data['SubscribeURL'])
-        print('Processing SubscriptionConfirmation....')
-        if response.status_code == 200:
-            return jsonify({"message": "Subscription confirmed"}), 200
+        try:
+            response = http_pool.request('GET', data['SubscribeURL'])
+        except urllib3.exceptions.HTTPError as e:
+            log.error("Failed to confirm subscription: %s", e)
+            return json_response({"error": "Failed to confirm subscription"}, 400)
+        log.info('Processing SubscriptionConfirmation....')
+        if response.status == 200:
+            return json_response({"message": "Subscription confirmed"})
         else:
-            return jsonify({"error": "Failed to confirm subscription"}), 400
+            return json_response({"error": "Failed to confirm subscription"}, 400)
     elif data['Type'] == 'Notification':
         
-        archive_details = json.loads(data['Message'])
+        archive_details = json_loads(data['Message'])
 
         s3_key_result_file = archive_details.get('s3_key_result_file')
         job_id = archive_details.get('job_id')
         user_id = archive_details.get('user_id')
-
-        profile = helpers.get_user_profile(user_id, accounts_database)
-        print('profile:', profile)
-
-        if profile[4] != 'free_user':
-            print("Premium user, do not need archive")
-            return jsonify({"message": "Premium user, do not need archive"}), 201
-        
-        print("Free_user, archiving....")
-        # MOVE FROM S3 To GLACIER
-
-        
-        # Upload the file to glacier
-        archive_id = move_to_glacier(s3_result_bucket_name, s3_key_result_file)
-        if archive_id is None:
-            return jsonify({"error": "In archive_app.py failed to upload the file to glacier"}), 400
-        
-        # remove file from s3
-        if not delete_from_s3(s3_result_bucket_name, s3_key_result_file):
-            return jsonify({"error": "In archive_app.py failed to delete file from s3"}), 400
-
-
-        # Update database
-        if not update_dynamodb(job_id, archive_id):
-            return jsonify({"error": "In archive_app.py failed to update database"}), 400
-
-        return jsonify({"message": "Archive request processed successfully"}), 201
+        # Reject malformed requests before any lookup or AWS call
+        if not all(isinstance(field, str) and field for field in (s3_key_result_file, job_id, user_id)):
+            log.error("Malformed archive request: %s", archive_details)
+            return json_response({"error": "Archive request is missing s3_key_result_file, job_id or user_id"}, 400)
+
+        # The tier recorded at submit time arrives as the user_tier message attribute (or in the
+        # message itself); a premium tier needs no archive, so skip the profile lookup entirely
+        user_tier = data.get('MessageAttributes', {}).get('user_tier', {}).get('Value') \
+            or archive_details.get('user_tier')
+        if user_tier is not None and user_tier != 'free_user':
+            log.info("Premium user, do not need archive")
+            return json_response({"message": "Premium user, do not need archive"}, 201)
+
+        # Archive before answering; an error status makes SNS deliver the request again,
+        # so no archive is lost if this instance fails or restarts mid-transfer. A redelivery
+        # that arrives while the first upload is still running is asked to come back later
+        archived = archive_results(job_id, user_id, s3_key_result_file)
+        if archived == BUSY:
+            return json_response({"error": f"Job {job_id} is already being archived"}, 503)
+        if not archived:
+            return json_response({"error": f"Failed to archive job {job_id}"}, 500)
+        return json_response({"message": "Archive request processed"})
 
 ### EOF
 
@@ -36,5 +36,19 @@ class Config(object):
 
     AWS_VAULT_NAME = "ucmpcs"
 
+    # Optional interface VPC endpoint URLs; unset means the regional endpoint
+    # (S3 and DynamoDB gateway endpoints need no URL, only a route table entry)
+    AWS_S3_ENDPOINT_URL = os.environ.get("S3_VPCE_URL")
+    AWS_DYNAMODB_ENDPOINT_URL = os.environ.get("DDB_VPCE_URL")
+
+    # Archives at least this large are sent to Glacier as a parallel multipart upload;
+    # the part size must be a power-of-two number of MiB
+    AWS_GLACIER_MULTIPART_THRESHOLD = 100 * 1024 * 1024
+    AWS_GLACIER_PART_SIZE = 8 * 1024 * 1024
+    AWS_GLACIER_UPLOAD_WORKERS = min(8, 2 * (os.cpu_count() or 1))
+
+    # An archive claim older than this many seconds was left by a request that died mid-upload
+    ARCHIVE_CLAIM_TIMEOUT = 900
+
 
 ### EOF
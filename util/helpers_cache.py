@@ -0,0 +1,55 @@
+# helpers_cache.py
+#
+# Cached wrappers around the shared helper functions
+#
+##
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import helpers
+
+# Get util configuration
+from configparser import ConfigParser, ExtendedInterpolation
+
+config = ConfigParser(os.environ, interpolation=ExtendedInterpolation())
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), "util_config.ini"))
+
+profile_cache_size = int(config.get('gas', 'ProfileCacheSize'))
+profile_cache_ttl = int(config.get('gas', 'ProfileCacheTtl'))
+
+# Most recently used profiles keyed by (user_id, db_name), each stored with its expiry time
+profile_cache = OrderedDict()
+profile_cache_lock = threading.Lock()
+
+
+def get_user_profile(id=None, db_name=None):
+    """
+    Return the user's profile, querying the accounts database only when the cached
+    copy is missing or older than ProfileCacheTtl seconds.
+    :param id: the user's identity id
+    :param db_name: the accounts database name
+    :return: the user's profile record
+    """
+    key = (id, db_name)
+    now = time.monotonic()
+    with profile_cache_lock:
+        entry = profile_cache.get(key)
+        if entry is not None and entry[1] > now:
+            profile_cache.move_to_end(key)
+            return entry[0]
+
+    # Query outside the lock so lookups for other users are not held up
+    profile = helpers.get_user_profile(id, db_name)
+
+    with profile_cache_lock:
+        profile_cache[key] = (profile, now + profile_cache_ttl)
+        profile_cache.move_to_end(key)
+        while len(profile_cache) > profile_cache_size:
+            profile_cache.popitem(last=False)
+    return profile
+
+
+### EOF
@@ -9,18 +9,29 @@ __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
 import boto3
 import json
+import logging
 import os
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
 
+from botocore.config import Config
 from botocore.exceptions import ClientError, BotoCoreError
 
+# Prefer the C-accelerated orjson parser when it is installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 # Import utility helpers
 sys.path.insert(1, os.path.realpath(os.path.pardir))
 import helpers
+import helpers_cache
 
 # Get configuration
 from configparser import ConfigParser, ExtendedInterpolation
@@ -39,6 +50,21 @@ accounts_database = config.get('gas', 'AccountsDatabase')
 job_detail_url_base = config.get('web', 'JobDetailUrlBase')
 aws_time_zone = config.get('aws', 'AwsTimeZone')
 
+# Log with lazily formatted arguments instead of eagerly built print strings
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(threadName)s %(levelname)s: %(message)s')
+log = logging.getLogger(__name__)
+
+# Create the SQS client once at import so its kept-alive connection is shared by every poll
+# Reference: Session and client reuse
+# https://boto3.amazonaws.com/v1/documentation/api/latest/guide/session.html
+# (the read timeout has to outlast the long poll)
+boto_config = Config(max_pool_connections=50, tcp_keepalive=True, connect_timeout=2, read_timeout=wait_time + 10,
+                     retries={'mode': 'adaptive', 'max_attempts': 3})
+sqs_client = boto3.client('sqs', region_name=aws_region, config=boto_config)
+
+# Threads that handle the messages of one batch concurrently
+message_executor = ThreadPoolExecutor(max_workers=max_number)
+
 def format_time(time_utc):
     # Helper function to display the date/time in the instance timezone
     # Reference : the usage of ZoneInfo
@@ -78,86 +104,104 @@ def read_message_from_queue(sqs):
         return response.get('Messages', [])
     except ClientError as e:
         # Handle specific AWS client errors, such as access issues or resource not found
-        print(f"An AWS ClientError occurred: {e.response['Error']['Code']} - {e.response['Error']['Message']}")
+        log.error("An AWS ClientError occurred: %s - %s", e.response['Error']['Code'], e.response['Error']['Message'])
         return []
     except BotoCoreError as e:
         # Handle errors in the boto3 library itself
-        print(f"A BotoCoreError occurred: {str(e)}")
+        log.error("A BotoCoreError occurred: %s", e)
         return []
     except Exception as e:
         # Optional: Catch any other unexpected errors
-        print(f"An unexpected error occurred: {str(e)}")
+        log.error("An unexpected error occurred: %s", e)
         return []
 
 
 def send_email_to_user(user_id, job_id, complete_time):
-    profile = helpers.get_user_profile(user_id, accounts_database)
-    print('profile: ', profile)
+    profile = helpers_cache.get_user_profile(user_id, accounts_database)
+    log.info('profile: %s', profile)
     subject = f"Subject: Results available for job {job_id}"
     link_to_details_page_for_job_id = job_detail_url_base + job_id
-    print(link_to_details_page_for_job_id)
+    log.info("Job details link: %s", link_to_details_page_for_job_id)
     body = f"Your annotation job completed at {complete_time}. Click here to view job details and results: {link_to_details_page_for_job_id}."
     helpers.send_email_ses(recipients=profile[2],
                    sender=mail_default_sender,
                    subject=subject, body=body)
 
 
-def delete_message(sqs, local_receipt_handle):
+def delete_messages(sqs, local_receipt_handles):
     """
-    Delete the message after the process spawned successfully
+    Delete a batch of messages after their emails were sent
 
-    :param sqs: the queue to delete message from
-    :param local_receipt_handle: the receipt handle extracted from the message
-    :return: True if the message was deleted correctly, False otherwise
+    :param sqs: the queue to delete messages from
+    :param local_receipt_handles: list of receipt handles extracted from the messages (at most 10)
+    :return: True if every message was deleted correctly, False otherwise
     """
-    # Delete the message from the queue
-    # Reference: Boto 3 documentation receive_message
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/receive_message.html
+    entries = [{'Id': str(i), 'ReceiptHandle': receipt_handle}
+               for i, receipt_handle in enumerate(local_receipt_handles)]
+    # Delete the messages from the queue in a single request
+    # Reference: Boto 3 documentation delete_message_batch
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/delete_message_batch.html
     try:
-        sqs.delete_message(
-            QueueUrl=queue_url,
-            ReceiptHandle=local_receipt_handle
-        )
-        return True
+        response = sqs.delete_message_batch(QueueUrl=queue_url, Entries=entries)
+        failed = response.get('Failed', [])
+        # Retry once the entries that failed on the service side
+        retry_ids = {failure['Id'] for failure in failed if not failure.get('SenderFault')}
+        if retry_ids:
+            response = sqs.delete_message_batch(QueueUrl=queue_url,
+                                                Entries=[entry for entry in entries if entry['Id'] in retry_ids])
+            failed = [failure for failure in failed if failure.get('SenderFault')] + response.get('Failed', [])
+        for failure in failed:
+            log.error("Failed to delete message %s: %s", failure['Id'], failure.get('Message', failure['Code']))
+        return not failed
     except ClientError as e:
         # ClientError caught from boto3 call
-        print(f"Failed to delete the message: {e.response['Error']['Message']}")
+        log.error("Failed to delete the messages: %s", e.response['Error']['Message'])
         return False
     except Exception as e:
         # General exception catch, if unexpected error occurs
-        print(f"An unexpected error occurred while deleting the message: {str(e)}")
+        log.error("An unexpected error occurred while deleting the messages: %s", e)
         return False
 
 
+def handle_message(message):
+    """
+    Email the user about one completed job.
+
+    :param message: the SQS message
+    :return: the message's receipt handle if the email was sent, None otherwise
+    """
+    try:
+        # Double parse JSON as per SNS-SQS integration format
+        data = json_loads(json_loads(message['Body'])['Message'])
+        user_id = data.get('user_id')
+        job_id = data.get('job_id')
+        complete_time = format_time(data.get('complete_time'))
+        # Process messages --> send email to user
+        send_email_to_user(user_id, job_id, complete_time)
+    except Exception as e:
+        # Leave the message on the queue so it is retried after the visibility timeout
+        log.error("An unexpected error occurred while handling a message: %s", e)
+        return None
+    return message['ReceiptHandle']
+
+
 def handle_results_queue(sqs=None):
     # Read messages from the queue
     messages = read_message_from_queue(sqs)
     if messages:
-        # Process messages
-        for message in messages:
-            # Double parse JSON as per SNS-SQS integration format
-            data = json.loads(json.loads(message['Body'])['Message'])
-            user_id = data.get('user_id')
-            job_id = data.get('job_id')
-            complete_time = format_time(data.get('complete_time'))
-            receipt_handle = message['ReceiptHandle']
-            # Process messages --> send email to user
-            send_email_to_user(user_id, job_id, complete_time)
-           # Delete the message after spawning the subprocess
-            if not delete_message(sqs, receipt_handle):
-                return 
-
-    
-
+        # Process messages concurrently so the profile lookups and SES calls overlap,
+        # and wait for the whole batch before polling again
+        receipt_handles = [receipt_handle for receipt_handle in message_executor.map(handle_message, messages)
+                           if receipt_handle is not None]
+        # Delete every message whose email was sent in one request
+        if receipt_handles:
+            delete_messages(sqs, receipt_handles)
 
 
 def main():
-    # Get handles to SQS
-    sqs = boto3.client('sqs', region_name=aws_region)
-
     # Poll queue for new results and process them
     while True:
-        handle_results_queue(sqs)
+        handle_results_queue(sqs_client)
 
 
 if __name__ == "__main__":
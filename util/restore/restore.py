@@ -9,88 +9,246 @@
 
 import boto3
 import json
+import logging
+import time
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
+# Prefer the C-accelerated orjson parser when it is installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Lambda already attaches a handler to the root logger; keep only warnings and errors in
+# CloudWatch and leave the per-record progress messages at debug level
+logging.getLogger().setLevel(logging.WARNING)
+log = logging.getLogger(__name__)
+
 # Define constants here; no config file is used for Lambdas
 AWS_REGION_NAME = "us-east-1"
 DYNAMODB_TABLE = "runqingc_annotations"
 AWS_S3_RESULTS_BUCKET = "gas-results"
 AWS_GLACIER_VAULT = "ucmpcs"
-RESTORE_QUEUE_URL = "https://sqs.us-east-1.amazonaws.com/127134666975/runqingc_a16_restore_requests"
 
-s3_client = boto3.client('s3', region_name=AWS_REGION_NAME)
-glacier_client = boto3.client('glacier', region_name=AWS_REGION_NAME)
+# A job being copied is marked RESTORING; a claim older than the Lambda timeout was left
+# by an invocation that died mid-copy, so a retry of the message may take it over
+RESTORING_STATUS = "RESTORING"
+RESTORE_CLAIM_TIMEOUT = 900
+
+# Clients are created once per Lambda container and reused by every warm invocation;
+# short timeouts and a single adaptive retry keep a slow DynamoDB call from stretching
+# the billed duration (the pool is sized for the record workers plus their concurrent transfer threads)
+boto_config = Config(max_pool_connections=96, tcp_keepalive=True, connect_timeout=1, read_timeout=5,
+                     retries={'mode': 'adaptive', 'max_attempts': 2})
+# Glacier job output and S3 parts move megabytes per call, so the transfer clients get a longer
+# read timeout and the normal retry budget instead of failing the whole restore on one slow read
+transfer_boto_config = boto_config.merge(Config(read_timeout=60, retries={'mode': 'adaptive', 'max_attempts': 10}))
+s3_client = boto3.client('s3', region_name=AWS_REGION_NAME, config=transfer_boto_config)
+glacier_client = boto3.client('glacier', region_name=AWS_REGION_NAME, config=transfer_boto_config)
+dynamodb_client = boto3.client('dynamodb', region_name=AWS_REGION_NAME, config=boto_config)
+
+# Stream restored archives into S3 as multipart uploads; at most
+# chunk size x concurrency bytes of an archive are held in memory
+# Reference: TransferConfig
+# https://boto3.amazonaws.com/v1/documentation/api/latest/reference/customizations/s3.html#boto3.s3.transfer.TransferConfig
+MB = 1024 * 1024
+transfer_config = TransferConfig(multipart_threshold=8 * MB, multipart_chunksize=8 * MB, max_concurrency=8,
+                                 use_threads=True)
+
+# Archives at least this large are copied as parallel ranged reads, each uploaded as one S3 part
+range_copy_threshold = 64 * MB
+range_part_size = 16 * MB
 
+# Threads that restore the records of one batch concurrently
+record_executor = ThreadPoolExecutor(max_workers=10)
 
+# Threads shared by every ranged copy, so at most 8 parts are in memory at once
+part_executor = ThreadPoolExecutor(max_workers=8)
 
-def find_s3_result_key(dynamodb, job_id):
-    # Find the s3_result_key based on job_id
-    primary_key = {'job_id': {'S': job_id}}
-    # Reference: get_item
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/table/get_item.html
+
+
+def claim_restored_job(dynamodb, job_id):
+    # Mark the job RESTORING and return its old restore fields with s3_key_result_file in one
+    # round-trip. The archive id is kept until the copy succeeds, so a crash mid-copy loses
+    # nothing; the condition makes a duplicate delivery fail while another claim is fresh.
+    # Re-setting s3_key_result_file to itself puts it in UPDATED_OLD, so the response carries
+    # only the attributes used here, not the whole job
+    # Reference: update_item
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/update_item.html
+    now = int(time.time())
     try:
-        response = dynamodb.get_item(TableName=DYNAMODB_TABLE, Key=primary_key)
-        item = response.get('Item')
-        if item:
-            s3_key_result_file = item.get('s3_key_result_file', {}).get('S') 
-            print("s3_key_result_file:", s3_key_result_file)
-            return s3_key_result_file 
-        else:
-            print("Item not found.")
-            return ''
+        response = dynamodb.update_item(
+            TableName=DYNAMODB_TABLE,
+            Key={
+                'job_id': {'S': job_id}
+            },
+            UpdateExpression="SET s3_key_result_file = s3_key_result_file, "
+                             "file_restore_status = :restoring, restore_claimed_at = :now",
+            ConditionExpression="attribute_exists(results_file_archive_id) AND "
+                                "(attribute_not_exists(restore_claimed_at) OR restore_claimed_at < :stale)",
+            ExpressionAttributeValues={
+                ':restoring': {'S': RESTORING_STATUS},
+                ':now': {'N': str(now)},
+                ':stale': {'N': str(now - RESTORE_CLAIM_TIMEOUT)}
+            },
+            ReturnValues="UPDATED_OLD",
+            ReturnValuesOnConditionCheckFailure="ALL_OLD"
+        )
+        item = response['Attributes']
+        item['restore_claimed_at'] = {'N': str(now)}
+        log.debug("s3_key_result_file: %s", item['s3_key_result_file']['S'])
+        return item
     except ClientError as e:
-        print("An error occurred:", e.response['Error']['Message'])
-        return ''
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            if 'results_file_archive_id' in e.response.get('Item', {}):
+                # Another invocation is copying this job; leave the message for a retry
+                log.warning("Job %s is already being restored.", job_id)
+                return None
+            # Nothing left to restore: an empty item tells the caller to just drop the message
+            log.warning("Job %s is not archived or was already restored.", job_id)
+            return {}
+        log.error("An error occurred: %s", e.response['Error']['Message'])
+        return None
     except Exception as e:
-        print("In restore.py, lambda, Other error happened when I try to retrieve the item with job_id")  
-        return '' 
- 
+        log.error("Unexpected error occurred while claiming the item with job_id %s: %s", job_id, e)
+        return None
+
 
-def delete_message(sqs_client, receipt_handle):
-    # delete a message
-    # Reference: delete_message
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/delete_message.html
+def finish_restored_job(dynamodb, job_id, item):
+    # Remove the archive id and the claim once the data is back in S3; the condition
+    # keeps a claim that was taken over by a retry from being finished twice
     try:
-        sqs_client.delete_message(
-                QueueUrl=RESTORE_QUEUE_URL,
-                ReceiptHandle=receipt_handle
-            )
+        dynamodb.update_item(
+            TableName=DYNAMODB_TABLE,
+            Key={
+                'job_id': {'S': job_id}
+            },
+            UpdateExpression="REMOVE results_file_archive_id, file_restore_status, restore_claimed_at",
+            ConditionExpression="restore_claimed_at = :claimed_at",
+            ExpressionAttributeValues={':claimed_at': item['restore_claimed_at']}
+        )
         return True
     except ClientError as e:
-        print(f"An error occurred: {e.response['Error']['Message']}")
+        log.error("An error occurred while finishing item with job_id %s: %s", job_id, e.response['Error']['Message'])
         return False
     except Exception as e:
-        print(f"Unexpected error occurred: {str(e)}")
+        log.error("Unexpected error occurred while finishing item with job_id %s: %s", job_id, e)
         return False
 
 
-def copy_to_s3(thaw_job_id, s3_key_result_file):
-    # copy the s3 file to its original position
+def release_restored_job(dynamodb, job_id, item):
+    # Drop the claim and put back the restore status it replaced, so a retry of the message can restore the job
+    expression_values = {':claimed_at': item['restore_claimed_at']}
+    if 'file_restore_status' in item:
+        expression_values[':restore_status'] = item['file_restore_status']
+        update_expression = "SET file_restore_status = :restore_status REMOVE restore_claimed_at"
+    else:
+        update_expression = "REMOVE file_restore_status, restore_claimed_at"
+    try:
+        dynamodb.update_item(
+            TableName=DYNAMODB_TABLE,
+            Key={
+                'job_id': {'S': job_id}
+            },
+            UpdateExpression=update_expression,
+            ConditionExpression="restore_claimed_at = :claimed_at",
+            ExpressionAttributeValues=expression_values
+        )
+        return True
+    except ClientError as e:
+        log.error("An error occurred while releasing item with job_id %s: %s", job_id, e.response['Error']['Message'])
+        return False
+    except Exception as e:
+        log.error("Unexpected error occurred while releasing item with job_id %s: %s", job_id, e)
+        return False
+ 
+
+def copy_range_to_s3(thaw_job_id, s3_key_result_file, upload_id, part_number, start, end):
+    # read one byte range of the job output and upload it as one part of the S3 multipart upload
     # Reference: get_job_output
     # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/get_job_output.html
+    response = glacier_client.get_job_output(
+        vaultName=AWS_GLACIER_VAULT,
+        jobId=thaw_job_id,
+        range=f"bytes={start}-{end}"
+    )
+    # Reference: upload_part
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/upload_part.html
+    part = s3_client.upload_part(
+        Bucket=AWS_S3_RESULTS_BUCKET,
+        Key=s3_key_result_file,
+        UploadId=upload_id,
+        PartNumber=part_number,
+        Body=response['body'].read()
+    )
+    return {'PartNumber': part_number, 'ETag': part['ETag']}
+
+
+def copy_ranges_to_s3(thaw_job_id, s3_key_result_file, archive_size):
+    # copy a large job output with concurrent ranged reads, one S3 part per range
+    # Reference: create_multipart_upload
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/create_multipart_upload.html
+    upload_id = s3_client.create_multipart_upload(Bucket=AWS_S3_RESULTS_BUCKET, Key=s3_key_result_file)['UploadId']
+    futures = []
+    try:
+        futures += [part_executor.submit(copy_range_to_s3, thaw_job_id, s3_key_result_file, upload_id,
+                                        part_number, start, min(start + range_part_size, archive_size) - 1)
+                   for part_number, start in enumerate(range(0, archive_size, range_part_size), start=1)]
+        # Reference: complete_multipart_upload
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/complete_multipart_upload.html
+        s3_client.complete_multipart_upload(
+            Bucket=AWS_S3_RESULTS_BUCKET,
+            Key=s3_key_result_file,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': [future.result() for future in futures]}
+        )
+    except Exception:
+        for future in futures:
+            future.cancel()
+        s3_client.abort_multipart_upload(Bucket=AWS_S3_RESULTS_BUCKET, Key=s3_key_result_file, UploadId=upload_id)
+        raise
+
+
+def copy_to_s3(thaw_job_id, s3_key_result_file):
+    # copy the s3 file to its original position
     try:
+        # Large archives are copied range by range in parallel instead of over one stream
+        # Reference: describe_job
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/describe_job.html
+        archive_size = glacier_client.describe_job(vaultName=AWS_GLACIER_VAULT, jobId=thaw_job_id)['ArchiveSizeInBytes']
+        if archive_size >= range_copy_threshold:
+            copy_ranges_to_s3(thaw_job_id, s3_key_result_file, archive_size)
+            log.debug("Data from Glacier archive %s has been copied to S3 key %s", thaw_job_id, s3_key_result_file)
+            return True
+
+        # Reference: get_job_output
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/get_job_output.html
         # Initiate the job to get the output
         response = glacier_client.get_job_output(
             vaultName=AWS_GLACIER_VAULT,
             jobId=thaw_job_id
         )
         
-        # Get the output stream
-        body = response['body'].read()
-        
-        # Upload the data to S3
-        s3_client.put_object(
+        # Stream the output into S3 without reading the whole archive into memory
+        # Reference: upload_fileobj
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/upload_fileobj.html
+        s3_client.upload_fileobj(
+            Fileobj=response['body'],
             Bucket=AWS_S3_RESULTS_BUCKET,
             Key=s3_key_result_file,
-            Body=body
+            Config=transfer_config
         )
-        print(f"Data from Glacier archive {thaw_job_id} has been copied to S3 key {s3_key_result_file}")
+        log.debug("Data from Glacier archive %s has been copied to S3 key %s", thaw_job_id, s3_key_result_file)
         return True
     except ClientError as e:
-        print(f"An error occurred: {e.response['Error']['Message']}")
+        log.error("An error occurred: %s", e.response['Error']['Message'])
         return False
     except Exception as e:
-        print(f"Unexpected error occurred: {str(e)}")
+        log.error("Unexpected error occurred: %s", e)
         return False
 
 
@@ -103,82 +261,93 @@ def delete_glacier_archive(archive_id):
             vaultName=AWS_GLACIER_VAULT,
             archiveId=archive_id
         )
-        print(f"Archive {archive_id} successfully deleted from Glacier.")
+        log.debug("Archive %s successfully deleted from Glacier.", archive_id)
         return True
     except ClientError as e:
-        print(f"An error occurred while deleting archive {archive_id}: {e.response['Error']['Message']}")
+        log.error("An error occurred while deleting archive %s: %s", archive_id, e.response['Error']['Message'])
         return False
     except Exception as e:
-        print(f"Unexpected error occurred while deleting archive {archive_id}: {str(e)}")
+        log.error("Unexpected error occurred while deleting archive %s: %s", archive_id, e)
         return False
 
 
-def delete_dynamodb_fields(dynamodb_client, job_id):
-    # delete the results_file_archive_id and file_restore_status fields to indicate the job complete
-    # Reference: update_item
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/update_item.html
+def restore_record(record):
+    # Restore the job of one SQS record; returns whether the record is done (False reports it
+    # as a batch item failure, so the message is retried), together with the glacier archive
+    # that is left to delete once the copy succeeded
+    # Parse the message body, rejecting malformed records before any AWS call
     try:
-        response = dynamodb_client.update_item(
-            TableName=DYNAMODB_TABLE,
-            Key={
-                'job_id': {'S': job_id}
-            },
-            UpdateExpression="REMOVE results_file_archive_id, file_restore_status",
-            ReturnValues="UPDATED_NEW"
-        )
-        print(f"Fields 'results_file_archive_id' and 'file_restore_status' successfully removed from item with job_id {job_id}.")
-        return True
-    except ClientError as e:
-        print(f"An error occurred while updating item with job_id {job_id}: {e.response['Error']['Message']}")
-        return False
-    except Exception as e:
-        print(f"Unexpected error occurred while updating item with job_id {job_id}: {str(e)}")
-        return False
-
-
-def lambda_handler(event, context):
-    sqs_client = boto3.client('sqs')
-    dynamodb = boto3.client('dynamodb', region_name=AWS_REGION_NAME)
-    queue_url = RESTORE_QUEUE_URL
-
-    for record in event['Records']:
-        # Parse the message body 
-        sns_message = json.loads(record['body'])
-        message = json.loads(sns_message['Message'])
+        message = json_loads(record['body'])
+        # With raw message delivery on the SNS subscription the body is the Glacier
+        # notification itself; otherwise it is wrapped in an SNS envelope
+        if message.get('Type') == 'Notification' and 'Message' in message:
+            message = json_loads(message['Message'])
 
         archive_id = message['ArchiveId']
         job_id = message['JobDescription']
         thaw_job_id = message['JobId']
-        print('thaw_job_id: ', thaw_job_id)
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        log.error("Malformed restore record %s: %s", record.get('messageId'), e)
+        return False, None
+    log.debug('thaw_job_id: %s', thaw_job_id)
 
-        print(f'Archive ID: {archive_id}')
-        print(f'Job Description: {job_id}')
+    log.debug('Archive ID: %s', archive_id)
+    log.debug('Job Description: %s', job_id)
 
-        # Find the s3_key_result_file of given job_id in dynamodb
-        s3_key_result_file = find_s3_result_key(dynamodb, job_id)
-        if s3_key_result_file == '':
-            continue
+    # Claim the job in dynamodb and get its s3_key_result_file in the same call
+    item = claim_restored_job(dynamodb_client, job_id)
+    if item is None:
+        return False, None
+    if not item:
+        # A redelivered message for a job that was already restored
+        return True, None
+    s3_key_result_file = item['s3_key_result_file']['S']
 
-        # Copy the restored data to S3 bucket    
-        if copy_to_s3(thaw_job_id, s3_key_result_file) == False:
-            continue   
+    # Copy the restored data to S3 bucket
+    if copy_to_s3(thaw_job_id, s3_key_result_file) == False:
+        release_restored_job(dynamodb_client, job_id, item)
+        return False, None
 
-        # Delete the message from the queue
-        receipt_handle = record['receiptHandle']
-        if delete_message(sqs_client, receipt_handle) == False:
-            continue
-        
-        # delete the glacier archive file
-        if delete_glacier_archive(archive_id) == False:
-            continue
-        
-        # update the dynamodb to indicate the job finish
-        if delete_dynamodb_fields(dynamodb, job_id) == False:
-            continue    
+    # Only now that the data is in S3 is the archive id removed; if this fails the message is
+    # retried, and the copy is repeated once the claim goes stale
+    if not finish_restored_job(dynamodb_client, job_id, item):
+        return False, None
+
+    # The job is restored, so its message is done; the glacier archive is deleted by the handler
+    return True, archive_id
+
+
+def lambda_handler(event, context):
+    # Restore the batch's records concurrently so their round-trips overlap;
+    # the clients are thread-safe and shared by every record
+    failed_message_ids = []
+    archive_ids = []
+    for record, future in [(record, record_executor.submit(restore_record, record)) for record in event['Records']]:
+        try:
+            restored, archive_id = future.result()
+        except Exception as e:
+            log.error("Unexpected error occurred while restoring record %s: %s", record.get('messageId'), e)
+            restored, archive_id = False, None
+        if not restored:
+            failed_message_ids.append(record['messageId'])
+        if archive_id is not None:
+            archive_ids.append(archive_id)
+
+    # Delete the restored archives from glacier concurrently
+    delete_futures = [record_executor.submit(delete_glacier_archive, archive_id) for archive_id in archive_ids]
+
+    # Lambda freezes its threads once the handler returns, so let the deletes finish first;
+    # a failed delete only leaves an orphaned archive behind and is logged by delete_glacier_archive
+    for future in delete_futures:
+        future.result()
 
+    # Lambda deletes the batch's messages itself, except the ones reported here, which
+    # stay on the queue for a retry (the SQS event source mapping must list
+    # ReportBatchItemFailures in its FunctionResponseTypes)
+    # Reference: Handling errors for an SQS event source
+    # https://docs.aws.amazon.com/lambda/latest/dg/services-sqs-errorhandling.html
     return {
-        'statusCode': 200,
-        'body': json.dumps('Messages processed successfully')
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_message_ids]
     }
 
     
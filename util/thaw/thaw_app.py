@@ -9,113 +9,141 @@ __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
 import boto3
 import json
-import requests
+import logging
+import urllib3
 import sys
 import time
 
+from botocore.config import Config
 from botocore.exceptions import ClientError, BotoCoreError, ParamValidationError
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request
+
+# Prefer the C-accelerated orjson parser and encoder when it is installed
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+    json_dumps = json.dumps
 
 app = Flask(__name__)
 app.url_map.strict_slashes = False
 
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(threadName)s %(levelname)s: %(message)s')
+log = logging.getLogger(__name__)
+
 # Get configuration and add to Flask app object
 environment = "thaw_app_config.Config"
 app.config.from_object(environment)
 aws_region = app.config['AWS_REGION_NAME']
 vault_name = app.config['AWS_GLACIER_VAULT']
+expedited_max_size = app.config['AWS_GLACIER_EXPEDITED_MAX_SIZE']
 annotations_table = app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE']
 user_index_name = app.config["AWS_DYNAMODB_ANNOTATIONS_TABLE_USER_INDEX"]
 restore_request_sns = app.config["AWS_RESTORE_REQUEST_SNS"]
 
+# Create the AWS clients once so every thaw request reuses the same kept-alive connections
+# Reference: Session and client reuse
+# https://boto3.amazonaws.com/v1/documentation/api/latest/guide/session.html
+boto_config = Config(max_pool_connections=50, tcp_keepalive=True, connect_timeout=2, read_timeout=10,
+                     retries={'mode': 'adaptive', 'max_attempts': 3})
+glacier_client = boto3.client('glacier', region_name=aws_region, config=boto_config)
+# The low-level DynamoDB client skips the resource layer's type (de)serialization
+dynamodb_client = boto3.client('dynamodb', region_name=aws_region, config=boto_config)
+
+# Keep the SubscribeURL confirmation connections alive between requests; urllib3 already
+# ships with botocore, so this avoids importing requests
+# Reference: urllib3 PoolManager
+# https://urllib3.readthedocs.io/en/stable/reference/urllib3.poolmanager.html
+http_pool = urllib3.PoolManager(num_pools=4, maxsize=4, retries=urllib3.Retry(3), timeout=urllib3.Timeout(total=5))
+
 
 
 def update_restore_status(job_id, status):
     # find the entry with job_id, and update its restoring status
-    dynamodb = boto3.resource('dynamodb', region_name=aws_region)
-    table = dynamodb.Table(annotations_table)
     # Reference: Update item
     # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/update_item.html
     try:
         # Update item in DynamoDB table
-        response = table.update_item(
+        dynamodb_client.update_item(
+            TableName=annotations_table,
             Key={
-                'job_id': job_id  
+                'job_id': {'S': job_id}
             },
             UpdateExpression="SET file_restore_status = :status",
             ExpressionAttributeValues={
-                ':status': status  
+                ':status': {'S': status}
             },
-            ReturnValues="UPDATED_NEW"
+            ReturnValues="NONE"
         )
         return True
     except ClientError as e:
         # Handle specific client errors as needed
-        print("DynamoDB Client Error:", e.response['Error']['Message'])
+        log.error("DynamoDB Client Error: %s", e.response['Error']['Message'])
         return False
     except Exception as e:
         # General exception handling
-        print("An unexpected error occurred:", str(e))
+        log.error("An unexpected error occurred: %s", e)
         return False
 
     
 
-def initiate_glacier_retrieval(job_id, archive_id):
+def request_retrieval(job_id, archive_id, tier):
+    # Initiate an archive retrieval at the given tier and record the tier as the restore status
+    # Reference: initiate_job
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/initiate_job.html
+    response = glacier_client.initiate_job(
+        vaultName=vault_name,
+        jobParameters={
+            'Type': 'archive-retrieval',
+            'ArchiveId': archive_id,
+            'Tier': tier,
+            'SNSTopic': restore_request_sns,
+            'Description': job_id
+        }
+    )
+    log.debug("%s retrieval initiated successfully, Job ID: %s", tier, response['jobId'])
+    update_restore_status(job_id, tier)
+    return response
+
+
+def initiate_glacier_retrieval(job_id, archive_id, archive_size=None):
     """
-        Given an archive_id, initiate the glacier retrieval
+        Given an archive_id, initiate the glacier retrieval and return its job id,
+        or '' if no retrieval could be initiated; archive_size, when known,
+        lets archives too large for an Expedited retrieval go straight to Standard
     """
-    print("Verify pass in parameters in initiate_glacier_retrieval in thaw, job_id, archive_id:", job_id, archive_id)
+    log.debug("initiate_glacier_retrieval job_id: %s, archive_id: %s, archive_size: %s", job_id, archive_id, archive_size)
 
-    # Create a Glacier client
-    glacier_client = boto3.client('glacier', region_name=aws_region)
     thaw_job_id = ''
-    # Try Expedited retrieval first
-    # Reference: initiate_job
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/initiate_job.html
+    # Try Expedited retrieval first, unless the archive is known to exceed its size limit
+    if archive_size is None or archive_size <= expedited_max_size:
+        try:
+            response = request_retrieval(job_id, archive_id, 'Expedited')
+            thaw_job_id = response['jobId']
+            return thaw_job_id
+        except ClientError as e:
+            # Check if the error is because of capacity constraints
+            if e.response['Error']['Code'] != 'InsufficientCapacityException':
+                log.error("Error initiating expedited retrieval: %s", e)
+                return thaw_job_id
+            log.warning("Expedited retrieval failed due to insufficient capacity. Trying standard retrieval...")
+
+    # Fall back to Standard retrieval
     try:
-        response = glacier_client.initiate_job(
-            vaultName=vault_name,
-            jobParameters={
-                'Type': 'archive-retrieval',
-                'ArchiveId': archive_id,
-                'Tier': 'Expedited',
-                'SNSTopic': restore_request_sns,
-                'Description': job_id
-            }
-        )
-        print("Expedited retrieval initiated successfully.")
-        print("Job ID:", response['jobId'])
-        update_restore_status(job_id, 'Expedited')
+        response = request_retrieval(job_id, archive_id, 'Standard')
+        thaw_job_id = response['jobId']
         return thaw_job_id
     except ClientError as e:
-        # Check if the error is because of capacity constraints
-        if e.response['Error']['Code'] == 'InsufficientCapacityException':
-            print("Expedited retrieval failed due to insufficient capacity. Trying standard retrieval...")
-            # Fall back to Standard retrieval
-            # Reference: initiate_job
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/initiate_job.html
-            try:
-                response = glacier_client.initiate_job(
-                    vaultName=vault_name,
-                    jobParameters={
-                        'Type': 'archive-retrieval',
-                        'ArchiveId': archive_id,
-                        'Tier': 'Standard',
-                        'SNSTopic': restore_request_sns,
-                        'Description': job_id
-                    }
-                )
-                print("Standard retrieval initiated successfully.")
-                print("Job ID:", response['jobId'])
-                update_restore_status(job_id, 'Standard')
-                return thaw_job_id
-            except ClientError as e:
-                print("Failed to initiate standard retrieval:", e)
-                return thaw_job_id
-        else:
-            print("Error initiating expedited retrieval:", e)
-            return thaw_job_id
+        log.error("Failed to initiate standard retrieval: %s", e)
+        return thaw_job_id
+
+
 
+def json_response(payload, status=200):
+    # Serialize the response body directly instead of going through jsonify
+    return Response(json_dumps(payload), status=status, mimetype='application/json')
 
 
 @app.route("/", methods=["GET"])
@@ -125,26 +153,31 @@ def home():
 
 @app.route("/thaw", methods=["POST"])
 def thaw_premium_user_data():
-    data = json.loads(request.data)
+    data = json_loads(request.data)
     if data['Type'] == 'SubscriptionConfirmation':
         # Confirm the subscription by visiting the SubscribeURL
-        response = requests.get(data['SubscribeURL'])
-        print('Processing SubscriptionConfirmation....')
-        if response.status_code == 200:
-            return jsonify({"message": "Subscription confirmed"}), 200
+        try:
+            response = http_pool.request('GET', data['SubscribeURL'])
+        except urllib3.exceptions.HTTPError as e:
+            log.error("Failed to confirm subscription: %s", e)
+            return json_response({"error": "Failed to confirm subscription"}, 400)
+        log.info('Processing SubscriptionConfirmation....')
+        if response.status == 200:
+            return json_response({"message": "Subscription confirmed"}, 200)
         else:
-            return jsonify({"error": "Failed to confirm subscription"}), 400
+            return json_response({"error": "Failed to confirm subscription"}, 400)
     elif data['Type'] == 'Notification':
-        print('Received Thaw request')
-        thaw_details = json.loads(data['Message'])
+        log.debug('Received Thaw request')
+        thaw_details = json_loads(data['Message'])
         job_id = thaw_details.get('job_id')
         archive_id = thaw_details.get('archive_id')
+        archive_size = thaw_details.get('archive_size')
         # initiate the glacier retrieval
-        thaw_job_id = initiate_glacier_retrieval(job_id, archive_id) 
+        thaw_job_id = initiate_glacier_retrieval(job_id, archive_id, archive_size)
         if thaw_job_id=='':
-            return jsonify({"error": "Failed to initiate thawing process"}), 400
+            return json_response({"error": "Failed to initiate thawing process"}, 400)
 
-        return jsonify({"message": "Notification received"}), 200
+        return json_response({"message": "Notification received"}, 200)
 
 
 ### EOF
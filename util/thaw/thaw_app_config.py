@@ -35,6 +35,8 @@ class Config(object):
 
     # AWS Glacier
     AWS_GLACIER_VAULT = "ucmpcs"
+    # Largest archive an Expedited retrieval can return; larger ones go straight to Standard
+    AWS_GLACIER_EXPEDITED_MAX_SIZE = 250 * 1024 * 1024
 
     AWS_RESTORE_REQUEST_SNS = "arn:aws:sns:us-east-1:127134666975:runqingc_a16_restore_requests"
 
@@ -173,6 +173,14 @@ class Config(object):
     # Time before free user results are archived (in seconds)
     FREE_USER_DATA_RETENTION = 300
 
+    # Job items kept in memory for the log view (entries, seconds)
+    JOB_CACHE_SIZE = 1024
+    JOB_CACHE_TTL = 30
+
+    # Seconds a finished job's details page may be revalidated with its ETag;
+    # must stay well below the presigned download URLs' one hour expiry
+    ANNOTATION_DETAILS_ETAG_WINDOW = 300
+
 
 class DevelopmentConfig(Config):
     DEBUG = True
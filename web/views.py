@@ -8,31 +8,92 @@
 ##
 __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
+import re
+import codecs
+import hashlib
 import uuid
 import time
 import json
-from datetime import datetime
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import wraps
 from zoneinfo import ZoneInfo
 
 import boto3
 from botocore.client import Config
-from boto3.dynamodb.conditions import Key
-from botocore.exceptions import ClientError, ParamValidationError, EndpointConnectionError, BotoCoreError
+from boto3.dynamodb.conditions import Attr, Key
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError, ParamValidationError, BotoCoreError
 
-from flask import abort, flash, redirect, render_template, request, session, url_for, jsonify
+from werkzeug.exceptions import HTTPException
+from flask import abort, flash, make_response, redirect, render_template, request, session, stream_template, url_for, jsonify
 
 from app import app, db
 from decorators import authenticated, is_premium
 from auth import get_profile
 
+# Prefer the C-accelerated orjson encoder when it is installed; SNS messages must be str
+try:
+    import orjson
+
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+except ImportError:
+    json_dumps = json.dumps
+
+# Read the configuration the views use on every request once
+aws_region = app.config["AWS_REGION_NAME"]
+key_prefix = app.config["AWS_S3_KEY_PREFIX"]
+inputs_bucket = app.config["AWS_S3_INPUTS_BUCKET"]
+results_bucket = app.config["AWS_S3_RESULTS_BUCKET"]
+annotations_table_name = app.config["AWS_DYNAMODB_ANNOTATIONS_TABLE"]
+job_request_topic = app.config["AWS_SNS_JOB_REQUEST_TOPIC"]
+thaw_request_topic = app.config["AWS_SNS_THAW_REQUEST_TOPIC"]
+
+# Create the AWS clients once at import so every request reuses the same clients
+# and their connection pools instead of rebuilding them per request
+# Reference: Session and client reuse
+# https://boto3.amazonaws.com/v1/documentation/api/latest/guide/session.html
+# Size the pools for the threaded WSGI server and keep their connections alive between requests
+# Reference: botocore Config
+# https://botocore.amazonaws.com/v1/documentation/api/latest/reference/config.html
+boto_config = Config(max_pool_connections=64, tcp_keepalive=True, connect_timeout=2, read_timeout=10,
+                     retries={'mode': 'adaptive', 'max_attempts': 5})
+s3_client = boto3.client(
+    "s3",
+    region_name=aws_region,
+    config=boto_config.merge(Config(signature_version="s3v4")),
+)
+sns_client = boto3.client('sns', region_name=aws_region, config=boto_config)
+dynamodb = boto3.resource('dynamodb', region_name=aws_region, config=boto_config)
+annotations_table = dynamodb.Table(annotations_table_name)
+# The low-level client serves the per-view job lookup without the resource layer's
+# request marshalling; only the projected attributes are deserialized
+dynamodb_client = boto3.client('dynamodb', region_name=aws_region, config=boto_config)
+type_deserializer = TypeDeserializer()
+
+# Publishes job requests after the confirmation page has been returned
+publish_executor = ThreadPoolExecutor(max_workers=8)
+
+
+# Input keys look like <prefix>/<user_id>/<job_id>~<file_name>; parse all three parts in one pass
+s3_key_pattern = re.compile(r'^[^/]+/([^/]+)/([^~/]+)~(.+)$')
+
+# The instance timezone is fixed for the life of the app, so look it up once
+local_timezone = ZoneInfo(app.config["AWS_TIMEZONE"])
+
 
 def format_time(time_utc):
     # Helper function to display the date/time in the instance timezone
     # Reference : the usage of ZoneInfo
     # https://docs.python.org/3/library/zoneinfo.html
-    dt_utc = datetime.strptime(time_utc, "%Y-%m-%dT%H:%M:%S.%fZ")
-    timezone = ZoneInfo(app.config["AWS_TIMEZONE"])
-    dt_local = dt_utc.replace(tzinfo=ZoneInfo('UTC')).astimezone(timezone)
+    # fromisoformat parses in C and keeps the UTC offset, so no strptime or tzinfo replace is needed
+    # Reference: datetime.fromisoformat
+    # https://docs.python.org/3/library/datetime.html#datetime.datetime.fromisoformat
+    dt_utc = datetime.fromisoformat(time_utc.replace('Z', '+00:00'))
+    dt_local = dt_utc.astimezone(local_timezone)
     formatted_time = dt_local.strftime("%Y-%m-%d @ %H:%M:%S")
     return formatted_time
 
@@ -63,6 +124,130 @@ def generate_download_url(s3_client, bucket_name, object_name, expiration=3600):
     return response
 
 
+"""Turn AWS errors raised in a view into logged error pages
+abort() responses raised by the view itself pass through unchanged
+"""
+
+
+def aws_errors(fn):
+    @wraps(fn)
+    def decorated_function(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except HTTPException:
+            raise
+        except ClientError as e:
+            # Handle client-side or server-side error from AWS
+            app.logger.error(f"ClientError in {fn.__name__}: {e.response['Error']['Message']}")
+            return abort(500)  # Internal server error
+        except ParamValidationError as e:
+            # Handle parameter validation errors
+            app.logger.error(f"Parameter Validation Error in {fn.__name__}: {str(e)}")
+            return abort(400)  # Bad request
+        except BotoCoreError as e:
+            # Handle connection and other errors from the core Boto3 library
+            app.logger.error(f"BotoCore Error in {fn.__name__}: {str(e)}")
+            return abort(500)  # Internal server error
+        except Exception as e:
+            # Generic handler for any other exceptions
+            app.logger.error(f"Unknown Error in {fn.__name__}: {str(e)}")
+            return abort(500)  # Internal server error
+
+    return decorated_function
+
+
+# Recently read jobs keyed by job_id, each stored with its expiry time, so the log view
+# opened from a details page does not read the same item again
+job_cache = OrderedDict()
+job_cache_lock = threading.Lock()
+
+# The job attributes the details and log views use; the rest of the item is never read
+job_view_attributes = ("job_id, user_id, submit_time, input_file_name, job_status, complete_time, "
+                       "s3_key_result_file, s3_key_log_file, results_file_archive_id, file_restore_status")
+
+
+def get_job(job_id, use_cache=False):
+    # Helper function to read a job item from DynamoDB, or None if there is no such job.
+    # With use_cache, a copy read within the last JOB_CACHE_TTL seconds is returned instead;
+    # only use it where the fields read never change after the job is created
+    # Reference: get_item
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/get_item.html
+    now = time.monotonic()
+    if use_cache:
+        with job_cache_lock:
+            entry = job_cache.get(job_id)
+            if entry is not None and entry[1] > now:
+                job_cache.move_to_end(job_id)
+                return entry[0]
+
+    response = dynamodb_client.get_item(
+        TableName=annotations_table_name,
+        Key={'job_id': {'S': job_id}},
+        ProjectionExpression=job_view_attributes
+    )
+    if 'Item' not in response:
+        app.logger.info("No item found with ID: {}".format(job_id))
+        return None
+    item = {name: type_deserializer.deserialize(value) for name, value in response['Item'].items()}
+
+    with job_cache_lock:
+        job_cache[job_id] = (item, now + app.config["JOB_CACHE_TTL"])
+        job_cache.move_to_end(job_id)
+        while len(job_cache) > app.config["JOB_CACHE_SIZE"]:
+            job_cache.popitem(last=False)
+    return item
+
+
+def publish_job_request(topic_arn, data):
+    # Helper function to publish a job request off the request thread; transient errors
+    # are retried by the client's adaptive retry mode. A request that still cannot be
+    # published is marked FAILED so it does not stay PENDING forever
+    # Reference: sns publish
+    # From AWS boto3 documentation - publish
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns/client/publish.html
+    try:
+        sns_client.publish(
+            TopicArn=topic_arn,
+            Message=json_dumps(data)
+        )
+        return True
+    except ClientError as e:
+        # Handle client-side or server-side error from AWS
+        app.logger.error(f"ClientError in SNS operation for job {data['job_id']}: {e.response['Error']['Message']}")
+    except (ParamValidationError, BotoCoreError) as e:
+        # Handle parameter validation, connection and other core Boto3 errors
+        app.logger.error(f"BotoCore Error in SNS operation for job {data['job_id']}: {str(e)}")
+    except Exception as e:
+        # Generic handler for any other exceptions
+        app.logger.error(f"Unknown Error in SNS operation for job {data['job_id']}: {str(e)}")
+
+    # Reference: update_item
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/table/update_item.html
+    try:
+        annotations_table.update_item(
+            Key={'job_id': data['job_id']},
+            UpdateExpression="SET job_status = :failed",
+            ConditionExpression="job_status = :pending",
+            ExpressionAttributeValues={':failed': 'FAILED', ':pending': 'PENDING'}
+        )
+    except Exception as e:
+        app.logger.error(f"Unable to mark job {data['job_id']} as failed: {str(e)}")
+    return False
+
+
+
+# The parts of the upload policy that are the same for every request
+upload_policy_fields = {
+    "x-amz-server-side-encryption": app.config["AWS_S3_ENCRYPTION"],
+    "acl": app.config["AWS_S3_ACL"],
+    "csrf_token": app.config["SECRET_KEY"],
+}
+upload_policy_conditions = (
+    {"x-amz-server-side-encryption": app.config["AWS_S3_ENCRYPTION"]},
+    {"acl": app.config["AWS_S3_ACL"]},
+    ["starts-with", "$csrf_token", ""],
+)
+
 
 """Start annotation request
 Create the required AWS S3 policy document and render a form for
@@ -76,47 +261,22 @@ but you can replace the code below with your own if you prefer.
 @app.route("/annotate", methods=["GET"])
 @authenticated
 def annotate():
-    # Open a connection to the S3 service
-    s3 = boto3.client(
-        "s3",
-        region_name=app.config["AWS_REGION_NAME"],
-        config=Config(signature_version="s3v4"),
-    )
-
-    bucket_name = app.config["AWS_S3_INPUTS_BUCKET"]
+    bucket_name = inputs_bucket
     user_id = session["primary_identity"]
 
     # Generate unique ID to be used as S3 key (name)
-    key_name = (
-            app.config["AWS_S3_KEY_PREFIX"]
-            + user_id
-            + "/"
-            + str(uuid.uuid4())
-            + "~${filename}"
-    )
+    key_name = f"{key_prefix}{user_id}/{uuid.uuid4()}~${{filename}}"
 
     # Create the redirect URL
     redirect_url = str(request.url) + "/job"
 
-    # Define policy conditions
-    encryption = app.config["AWS_S3_ENCRYPTION"]
-    acl = app.config["AWS_S3_ACL"]
-    fields = {
-        "success_action_redirect": redirect_url,
-        "x-amz-server-side-encryption": encryption,
-        "acl": acl,
-        "csrf_token": app.config["SECRET_KEY"],
-    }
-    conditions = [
-        ["starts-with", "$success_action_redirect", redirect_url],
-        {"x-amz-server-side-encryption": encryption},
-        {"acl": acl},
-        ["starts-with", "$csrf_token", ""],
-    ]
+    # Define policy conditions; only the redirect differs between requests
+    fields = {"success_action_redirect": redirect_url, **upload_policy_fields}
+    conditions = [["starts-with", "$success_action_redirect", redirect_url], *upload_policy_conditions]
 
     # Generate the presigned POST call
     try:
-        presigned_post = s3.generate_presigned_post(
+        presigned_post = s3_client.generate_presigned_post(
             Bucket=bucket_name,
             Key=key_name,
             Fields=fields,
@@ -145,18 +305,19 @@ homework assignments
 
 @app.route("/annotate/job", methods=["GET"])
 @authenticated
+@aws_errors
 def create_annotation_job_request():
-    region = app.config["AWS_REGION_NAME"]
-
     # Parse redirect URL query parameters for S3 object info
     bucket_name = request.args.get("bucket")
     s3_key = request.args.get("key")
 
-    # Extract the job ID from the S3 key
-    job_id = s3_key.split('/')[2].split('~')[0]
-    user_name = s3_key.split('/')[1]
-    file_name = s3_key.split('/')[2].split('~')[1]
-    submit_time = datetime.utcnow().isoformat() + 'Z'
+    # Extract the user, job ID and file name from the S3 key
+    key_match = s3_key_pattern.match(s3_key or '')
+    if key_match is None:
+        app.logger.error(f"Unexpected S3 key in upload redirect: {s3_key}")
+        return abort(400)
+    user_name, job_id, file_name = key_match.groups()
+    submit_time = datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
     # Persist job to database
     data = {"job_id": job_id,
             "user_id": user_name,
@@ -164,64 +325,19 @@ def create_annotation_job_request():
             "s3_inputs_bucket": bucket_name,
             "s3_key_input_file": s3_key,
             "submit_time": submit_time,
-            "job_status": "PENDING"
+            "job_status": "PENDING",
+            # lets the archive step skip premium users without a profile lookup
+            "user_role": session["role"]
             }
 
-    # Initialize a boto3 client
     # Reference: Table: dynamodb.Table operation
     # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/table/index.html
-    dynamodb = boto3.resource('dynamodb', region_name=region)
-    table = dynamodb.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
-    try:
-        table.put_item(Item=data)
-    except ClientError as e:
-        # Handle client-side errors (e.g., missing table, bad request format)
-        app.logger.error(f"ClientError in DynamoDB operation: {e}")
-        return abort(500)
-    except BotoCoreError as e:
-        # Handle errors that are less straightforward, could be due to issues on boto3's end
-        app.logger.error(f"BotoCoreError in DynamoDB operation: {e}")
-        return abort(500)
-    except Exception as e:
-        # General exception catch block, just in case
-        app.logger.error(f"Unexpected error: {e}")
-        return abort(500)
+    annotations_table.put_item(Item=data)
 
-    # Send message to request queue
-    # Create an SNS client
-    # Reference: SNS Client
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns.html
-    sns = boto3.client('sns', region_name=app.config["AWS_REGION_NAME"])
-    topic_arn = app.config["AWS_SNS_JOB_REQUEST_TOPIC"]
-    # Reference: sns publish
-    # From AWS boto3 documentation - publish
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns/client/publish.html
-    try:
-        response = sns.publish(
-            TopicArn=topic_arn,
-            Message=json.dumps(data)
-        )
-        print(response)
-    except ClientError as e:
-        # Handle client-side or server-side error from AWS
-        app.logger.error(f"ClientError in SNS operation: {e.response['Error']['Message']}")
-        return abort(500)  # Use abort to trigger the 500 error handler
-    except ParamValidationError as e:
-        # Handle parameter validation errors
-        app.logger.error(f"Parameter Validation Error: {str(e)}")
-        return abort(400)  # Use abort to trigger the 400 error handler
-    except EndpointConnectionError as e:
-        # Handle connection errors
-        app.logger.error(f"Endpoint Connection Error: {str(e)}")
-        return abort(500)  # Use abort to trigger the 500 error handler
-    except BotoCoreError as e:
-        # Handle errors from the core Boto3 library
-        app.logger.error(f"BotoCore Error: {str(e)}")
-        return abort(500)  # Use abort for 500 errors
-    except Exception as e:
-        # Generic handler for any other exceptions
-        app.logger.error(f"Unknown Error: {str(e)}")
-        return abort(500)  # Use abort for 500 errors
+    # Send message to request queue; the job is already saved, so the confirmation
+    # page does not wait on the publish round-trip
+    topic_arn = job_request_topic
+    publish_executor.submit(publish_job_request, topic_arn, data)
 
     return render_template("annotate_confirm.html", job_id=job_id)
 
@@ -232,53 +348,47 @@ def create_annotation_job_request():
 
 @app.route("/annotations", methods=["GET"])
 @authenticated
+@aws_errors
 def annotations_list():
-    region = app.config["AWS_REGION_NAME"]
     # Get list of annotations to display
     user_id = session.get('primary_identity')
     # handle unauthorized access
     if user_id is None:
         return abort(403)
     # Query the dynamodb to retrieve information
-    dynamodb = boto3.resource('dynamodb', region_name=region)
-    table = dynamodb.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
-
     # Reference: How to query to dynamodb using index
     # From AWS boto3 documentation - query
     # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/query.html
-    try:
-        response = table.query(
-            IndexName=app.config["AWS_S3_SECONDARY_INDEX"],
-            KeyConditionExpression=Key('user_id').eq(user_id)
-        )
-    except ClientError as e:
-        # Handle client-side or server-side error from AWS
-        app.logger.error(f"ClientError in DynamoDB operation: {e.response['Error']['Message']}")
-        return abort(500)  # Use abort to trigger the 500 error handler
-    except ParamValidationError as e:
-        # Handle parameter validation errors
-        app.logger.error(f"Parameter Validation Error: {str(e)}")
-        return abort(400)  # Use abort to trigger the 400 error handler
-    except EndpointConnectionError as e:
-        # Handle connection errors to AWS services
-        app.logger.error(f"Endpoint Connection Error: {str(e)}")
-        return abort(500)  # Use abort to trigger the 500 error handler
-    except BotoCoreError as e:
-        # Handle errors from the core Boto3 library
-        app.logger.error(f"BotoCore Error: {str(e)}")
-        return abort(500)  # Use abort for 500 errors
-    except Exception as e:
-        # Generic handler for any other exceptions
-        app.logger.error(f"Unknown Error: {str(e)}")
-        return abort(500)  # Use abort for 500 errors
-
-    annotations = []
-    for item in response['Items']:
-        annotations.append(
-            {"id": item['job_id'], "request_time": format_time(item['submit_time']), "file_name": item['input_file_name'],
-             "status": item['job_status']})
-
-    return render_template("annotations.html", annotations=annotations)
+    # Only fetch the attributes the list shows; the first page is read here so errors
+    # still get an error page, and later pages are read while the list is streamed
+    query_args = {
+        'IndexName': app.config["AWS_S3_SECONDARY_INDEX"],
+        'KeyConditionExpression': Key('user_id').eq(user_id),
+        'ProjectionExpression': 'job_id, submit_time, input_file_name, job_status'
+    }
+    response = annotations_table.query(**query_args)
+
+    # Reference: Streaming with templates
+    # https://flask.palletsprojects.com/en/stable/patterns/streaming/
+    return stream_template("annotations.html", annotations=annotation_rows(query_args, response))
+
+
+def annotation_rows(query_args, response):
+    # Yield the list rows of each page of the user's jobs, following LastEvaluatedKey so
+    # users with more than a 1 MB page of jobs still see all of them. The response has
+    # started by the time later pages are read, so a failure there ends the list early
+    while True:
+        for item in response['Items']:
+            yield {"id": item['job_id'], "request_time": format_time(item['submit_time']),
+                   "file_name": item['input_file_name'], "status": item['job_status']}
+        if 'LastEvaluatedKey' not in response:
+            return
+        query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        try:
+            response = annotations_table.query(**query_args)
+        except Exception as e:
+            app.logger.error(f"Error reading the next page of annotations: {str(e)}")
+            return
 
 
 """Display details of a specific annotation job
@@ -287,35 +397,12 @@ def annotations_list():
 
 @app.route("/annotations/<id>", methods=["GET"])
 @authenticated
+@aws_errors
 def annotation_details(id):
 
-    dynamodb = boto3.resource('dynamodb', region_name=app.config["AWS_REGION_NAME"])
-    table = dynamodb.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
-    key = {'job_id': id}
-    try:
-        response = table.get_item(Key=key)
-        # Check if item was found
-        if 'Item' not in response:
-            app.logger.info("No item found with ID: {}".format(id))
-            return abort(404)  # Not found
-    except ClientError as e:
-        app.logger.error(f"ClientError in DynamoDB operation: {e.response['Error']['Message']}")
-        return abort(500)  # Internal server error
-    except ParamValidationError as e:
-        app.logger.error(f"Parameter Validation Error: {str(e)}")
-        return abort(400)  # Bad request
-    except EndpointConnectionError as e:
-        app.logger.error(f"Endpoint Connection Error: {str(e)}")
-        return abort(500)  # Internal server error
-    except BotoCoreError as e:
-        app.logger.error(f"BotoCore Error: {str(e)}")
-        return abort(500)  # Internal server error
-    except Exception as e:
-        # Generic handler for any other exceptions
-        app.logger.error(f"Unknown Error: {str(e)}")
-        return abort(500)  # Internal server error
+    # Always read the job fresh here: its status and archive fields change over time
+    job_detail = get_job(id)
 
-    job_detail = response.get('Item')
     # handle error when user typed in an invalid job detail
     if job_detail is None:
         return abort(404)
@@ -324,14 +411,25 @@ def annotation_details(id):
     # check the requested job ID belongs to the user that is currently authenticated
     if user_id != job_detail['user_id']:
         return abort(403)
-    
+
+    # A finished job's page only changes with its archive and restore state, so let the
+    # browser revalidate it with an ETag instead of presigning and rendering it again.
+    # The window keeps a reused page's presigned URLs well inside their expiry
+    etag = None
+    if job_detail['job_status'] in ('COMPLETED', 'FAILED'):
+        page_version = (job_detail['job_id'], job_detail['job_status'], job_detail.get('complete_time'),
+                        job_detail.get('results_file_archive_id'), job_detail.get('file_restore_status'),
+                        session.get('role'), session.get('name'),
+                        int(time.time() // app.config["ANNOTATION_DETAILS_ETAG_WINDOW"]))
+        etag = hashlib.sha256(repr(page_version).encode()).hexdigest()
+        if request.if_none_match.contains(etag):
+            response = make_response('', 304)
+            response.set_etag(etag)
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+
     # Retrieve information
-    # Open a connection to the S3 service
-    s3 = boto3.client(
-        "s3",
-        region_name=app.config["AWS_REGION_NAME"],
-        config=Config(signature_version="s3v4"),
-    )
     request_id = job_detail['job_id']
     request_time = format_time(job_detail['submit_time'])
     vcf_input_file = job_detail['input_file_name']
@@ -346,41 +444,31 @@ def annotation_details(id):
     result_file_download_url = ''
     log_file_view_url = ''
     # Generate unique ID to be used as S3 key (name)
-    input_file_key_name = (
-            app.config["AWS_S3_KEY_PREFIX"]
-            + user_id
-            + "/"
-            + request_id
-            + "~"
-            + vcf_input_file
-    )
-    input_file_download_url = generate_download_url(s3, app.config["AWS_S3_INPUTS_BUCKET"], input_file_key_name)
+    input_file_key_name = f"{key_prefix}{user_id}/{request_id}~{vcf_input_file}"
+    input_file_download_url = generate_download_url(s3_client, inputs_bucket, input_file_key_name)
     if status == 'COMPLETED':
         complete_time = format_time(job_detail['complete_time'])
-        # print("input_file_key_name: ", input_file_key_name)
-        result_file_key_name = (
-            app.config["AWS_S3_KEY_PREFIX"]
-            + user_id
-            + "/"
-            + request_id
-            + "/"
-            + vcf_input_file.split('.')[0]
-            + ".annot.vcf"
-        )
-        result_file_download_url = generate_download_url(s3, app.config["AWS_S3_RESULTS_BUCKET"], result_file_key_name)
+        # The annotator records the keys it uploaded to; build them only for older jobs
+        result_file_key_name = job_detail.get('s3_key_result_file') or \
+            f"{key_prefix}{user_id}/{request_id}/{vcf_input_file.split('.')[0]}.annot.vcf"
+        result_file_download_url = generate_download_url(s3_client, results_bucket, result_file_key_name)
         log_file_view_url = url_for('annotation_log', id=id)
-        print("log_file_view_url:", log_file_view_url)
-    return render_template("annotation.html", request_id=request_id,
-                           request_time=request_time,
-                           vcf_input_file=vcf_input_file,
-                           status=status,
-                           complete_time=complete_time,
-                           input_file_download_url=input_file_download_url,
-                           result_file_download_url=result_file_download_url,
-                           log_file_view_url=log_file_view_url,
-                           results_file_archive_id=results_file_archive_id,
-                           file_restore_status=file_restore_status
-                           )
+    response = make_response(render_template("annotation.html", request_id=request_id,
+                             request_time=request_time,
+                             vcf_input_file=vcf_input_file,
+                             status=status,
+                             complete_time=complete_time,
+                             input_file_download_url=input_file_download_url,
+                             result_file_download_url=result_file_download_url,
+                             log_file_view_url=log_file_view_url,
+                             results_file_archive_id=results_file_archive_id,
+                             file_restore_status=file_restore_status
+                             ))
+    if etag is not None:
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
 
 
 """Display the log file contents for an annotation job
@@ -389,35 +477,12 @@ def annotation_details(id):
 
 @app.route("/annotations/<id>/log", methods=["GET"])
 @authenticated
+@aws_errors
 def annotation_log(id):
-    # check the requested job ID belongs to the user that is currently authenticated
-    dynamodb = boto3.resource('dynamodb', region_name=app.config["AWS_REGION_NAME"])
-    table = dynamodb.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
-    key = {'job_id': id}
-    try:
-        response = table.get_item(Key=key)
-        # Check if item was found
-        if 'Item' not in response:
-            app.logger.info("No item found with ID: {}".format(id))
-            return abort(404)  # Not found
-    except ClientError as e:
-        app.logger.error(f"ClientError in DynamoDB operation: {e.response['Error']['Message']}")
-        return abort(500)  # Internal server error
-    except ParamValidationError as e:
-        app.logger.error(f"Parameter Validation Error: {str(e)}")
-        return abort(400)  # Bad request
-    except EndpointConnectionError as e:
-        app.logger.error(f"Endpoint Connection Error: {str(e)}")
-        return abort(500)  # Internal server error
-    except BotoCoreError as e:
-        app.logger.error(f"BotoCore Error: {str(e)}")
-        return abort(500)  # Internal server error
-    except Exception as e:
-        # Generic handler for any other exceptions
-        app.logger.error(f"Unknown Error: {str(e)}")
-        return abort(500)  # Internal server error
+    # check the requested job ID belongs to the user that is currently authenticated;
+    # the owner, job id and input file name never change, so a recently read copy will do
+    job_detail = get_job(id, use_cache=True)
 
-    job_detail = response.get('Item')
     # handle error when user typed in an invalid job detail
     if job_detail is None:
         return abort(404)
@@ -431,94 +496,142 @@ def annotation_log(id):
     request_id = job_detail['job_id']
     vcf_input_file = job_detail['input_file_name']
 
-    # Open a connection to the S3 service
-    s3 = boto3.client(
-        "s3",
-        region_name=app.config["AWS_REGION_NAME"],
-        config=Config(signature_version="s3v4"),
-    )
+    log_file_key_name = job_detail.get('s3_key_log_file') or \
+        f"{key_prefix}{user_id}/{request_id}/{vcf_input_file}.count.log"
+    app.logger.debug("log_file_key_name: %s", log_file_key_name)
 
-    log_file_key_name = (
-            app.config["AWS_S3_KEY_PREFIX"]
-            + user_id
-            + "/"
-            + request_id
-            + "/"
-            + vcf_input_file
-            + ".count.log"
-        )
-    print("log_file_key_name: ", log_file_key_name)
+    # open the log file; its content is streamed into the page as S3 delivers it
+    log_obj = s3_client.get_object(Bucket=results_bucket, Key=log_file_key_name)
 
-    # retrieve the file content as a string
-    # show
+    return stream_template("view_log.html", log_contents=log_chunks(log_obj['Body']), job_id=request_id)
+
+
+def log_chunks(body, chunk_size=64 * 1024):
+    # Yield the decoded text of an S3 body chunk by chunk; the incremental decoder keeps
+    # a UTF-8 character split across two chunks intact
+    # Reference: codecs incremental decoders
+    # https://docs.python.org/3/library/codecs.html#codecs.getincrementaldecoder
+    decoder = codecs.getincrementaldecoder('utf-8')()
     try:
-        # Retrieve the log file content
-        log_obj = s3.get_object(Bucket=app.config["AWS_S3_RESULTS_BUCKET"], Key=log_file_key_name)
-        log_contents = log_obj['Body'].read().decode('utf-8')
-    except ClientError as e:
-        app.logger.error(f"Error retrieving log file from S3: {e.response['Error']['Message']}")
-        return abort(500)  # Internal server error
-    except ParamValidationError as e:
-        app.logger.error(f"Parameter Validation Error: {str(e)}")
-        return abort(400)  # Bad request
-    except EndpointConnectionError as e:
-        app.logger.error(f"Endpoint Connection Error: {str(e)}")
-        return abort(500)  # Internal server error
-    except BotoCoreError as e:
-        app.logger.error(f"BotoCore Error: {str(e)}")
-        return abort(500)  # Internal server error
+        for chunk in body.iter_chunks(chunk_size):
+            yield decoder.decode(chunk)
+        yield decoder.decode(b'', final=True)
     except Exception as e:
-        app.logger.error(f"Unknown Error: {str(e)}")
-        return abort(500)  # Internal server error
-
-    return render_template("view_log.html", log_contents=log_contents, job_id=request_id)
+        # The page has already started, so end the log early
+        app.logger.error(f"Error streaming log file from S3: {str(e)}")
+    finally:
+        body.close()
 
 
 """Subscription management handler
 """
+import requests
 import stripe
 from stripe.error import StripeError, CardError
 from auth import update_profile
 
+# Configure Stripe once, sending every API call through one shared requests session so the
+# customer and subscription calls reuse a kept-alive connection instead of each paying a TLS handshake
+# Reference: Configuring an HTTP client
+# https://github.com/stripe/stripe-python#configuring-an-http-client
+stripe.api_key = app.config["STRIPE_SECRET_KEY"]
+stripe.default_http_client = stripe.http_client.RequestsClient(session=requests.Session())
+
 def get_user_archive_jobs(user_id):
     """
-        Given a user_id, return all tuples of (job_id, archive_id) from DynamoDB
+        Given a user_id, return all tuples of (job_id, archive_id, archive_size) from DynamoDB;
+        archive_size is None for archives recorded before their size was stored
     """
-    # Create a DynamoDB resource using boto3
-    dynamodb = boto3.resource('dynamodb', region_name=app.config["AWS_REGION_NAME"])
-    # Specify the table name
-    table = dynamodb.Table(app.config["AWS_DYNAMODB_ANNOTATIONS_TABLE"])
-
-    # Query the table using the index
+    # Query the table using the index; the filter drops jobs that are not archived before
+    # they are returned, and LastEvaluatedKey is followed since each page is filtered separately
+    query_args = {
+        'IndexName': app.config["AWS_DYNAMODB_ANNOTATIONS_TABLE_USER_INDEX"],
+        'KeyConditionExpression': Key('user_id').eq(user_id),
+        'FilterExpression': Attr('results_file_archive_id').exists(),
+        'ProjectionExpression': 'job_id, results_file_archive_id, results_file_archive_size'
+    }
     try:
-        response = table.query(
-            IndexName=app.config["AWS_DYNAMODB_ANNOTATIONS_TABLE_USER_INDEX"],
-            KeyConditionExpression=boto3.dynamodb.conditions.Key('user_id').eq(user_id)
-        )
-
-        # Collect all tuples of (job_id, archive_id) from the query response
-        archive_jobs = [
-            (item['job_id'], item['results_file_archive_id']) for item in response['Items']
-            if 'job_id' in item and 'results_file_archive_id' in item
-        ]
-
-        return archive_jobs
-
-        return results_file_archive_ids
+        archive_jobs = []
+        while True:
+            response = annotations_table.query(**query_args)
+
+            # Collect all tuples of (job_id, archive_id, archive_size) from the query response
+            archive_jobs.extend(
+                (item['job_id'], item['results_file_archive_id'],
+                 int(item['results_file_archive_size']) if 'results_file_archive_size' in item else None)
+                for item in response['Items']
+            )
+            if 'LastEvaluatedKey' not in response:
+                return archive_jobs
+            query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
     except ClientError as e:
         # Handle common client errors from the service side (e.g., table not found)
-        print(f"An error occurred: {e.response['Error']['Message']}")
+        app.logger.error(f"An error occurred: {e.response['Error']['Message']}")
         return []
     except ParamValidationError as e:
         # Handle errors due to the incorrect parameters
-        print(f"Parameter validation error: {e}")
+        app.logger.error(f"Parameter validation error: {e}")
         return []
     except Exception as e:
         # Handle other possible exceptions
-        print(f"An unexpected error occurred: {e}")   
+        app.logger.error(f"An unexpected error occurred: {e}")   
         return []
 
 
+def publish_thaw_requests(user_id):
+    """
+        Publish a thaw request for each of the user's archived jobs; runs on publish_executor
+        after the subscription has been confirmed, so failures are logged rather than shown
+    """
+    topic_arn = thaw_request_topic
+    archive_jobs = get_user_archive_jobs(user_id)
+
+    # Publish the thaw requests ten at a time, the most a single publish_batch call accepts
+    published = True
+    for start in range(0, len(archive_jobs), 10):
+        entries = [
+            {
+                'Id': str(i),
+                'Message': json_dumps({
+                    "job_id": job_id,
+                    "archive_id": archive_id,
+                    "archive_size": archive_size
+                })
+            }
+            for i, (job_id, archive_id, archive_size) in enumerate(archive_jobs[start:start + 10])
+        ]
+        # Reference: sns publish_batch
+        # From AWS boto3 documentation - publish_batch
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns/client/publish_batch.html
+        try:
+            response = sns_client.publish_batch(
+                TopicArn=topic_arn,
+                PublishBatchRequestEntries=entries
+            )
+        except ClientError as e:
+            # Handle client-side or server-side error from AWS
+            app.logger.error(f"ClientError publishing thaw requests for {user_id}: {e.response['Error']['Message']}")
+            published = False
+            continue
+        except (ParamValidationError, BotoCoreError) as e:
+            # Handle parameter validation, connection and other core Boto3 errors
+            app.logger.error(f"BotoCore Error publishing thaw requests for {user_id}: {str(e)}")
+            published = False
+            continue
+        except Exception as e:
+            # Generic handler for any other exceptions
+            app.logger.error(f"Unknown Error publishing thaw requests for {user_id}: {str(e)}")
+            published = False
+            continue
+
+        # The batch call succeeds even when some of its entries are rejected
+        for failure in response.get('Failed', []):
+            app.logger.error(f"Failed to publish thaw request for job {archive_jobs[start + int(failure['Id'])][0]}: "
+                             f"{failure.get('Message', failure['Code'])}")
+            published = False
+    return published
+
+
 @app.route("/subscribe", methods=["GET", "POST"])
 @authenticated
 def subscribe():
@@ -532,7 +645,6 @@ def subscribe():
         user_name = session['name']
         user_email = session['email']
         price_id = app.config["STRIPE_PRICE_ID"]
-        stripe.api_key = app.config["STRIPE_SECRET_KEY"]
         # Reference: Create a customer
         # https://docs.stripe.com/api/customers/create
         try:
@@ -574,51 +686,9 @@ def subscribe():
         # # Request restoration of the user's data from Glacier
         # # ...add code here to initiate restoration of archived user data
         # # ...and make sure you handle files pending archive!
-        # Send message to request queue
-        # Create an SNS client
-        # Reference: SNS Client
-        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns.html
-        sns = boto3.client('sns', region_name=app.config["AWS_REGION_NAME"])
-        topic_arn = app.config["AWS_SNS_THAW_REQUEST_TOPIC"]
-        user_id = session['primary_identity']
-
-        archive_jobs = get_user_archive_jobs(user_id)
-
-        for job_id, archive_id in archive_jobs:
-            data = {
-                    "job_id": job_id,
-                    "archive_id": archive_id
-            }
-            # Reference: sns publish
-            # From AWS boto3 documentation - publish
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns/client/publish.html
-            try:
-                response = sns.publish(
-                    TopicArn=topic_arn,
-                    Message=json.dumps(data)
-                )
-                print(response)
-            except ClientError as e:
-                # Handle client-side or server-side error from AWS
-                app.logger.error(f"ClientError in SNS operation: {e.response['Error']['Message']}")
-                return abort(500)  # Use abort to trigger the 500 error handler
-            except ParamValidationError as e:
-                # Handle parameter validation errors
-                app.logger.error(f"Parameter Validation Error: {str(e)}")
-                return abort(400)  # Use abort to trigger the 400 error handler
-            except EndpointConnectionError as e:
-                # Handle connection errors
-                app.logger.error(f"Endpoint Connection Error: {str(e)}")
-                return abort(500)  # Use abort to trigger the 500 error handler
-            except BotoCoreError as e:
-                # Handle errors from the core Boto3 library
-                app.logger.error(f"BotoCore Error: {str(e)}")
-                return abort(500)  # Use abort for 500 errors
-            except Exception as e:
-                # Generic handler for any other exceptions
-                app.logger.error(f"Unknown Error: {str(e)}")
-                return abort(500)  # Use abort for 500 errors
-
+        # The confirmation page only needs the subscription and role; finding and
+        # publishing the user's archived jobs runs after it has been returned
+        publish_executor.submit(publish_thaw_requests, session['primary_identity'])
 
         # # Display confirmation page
         return render_template('subscribe_confirm.html', stripe_id=customer.id)